@@ -10,8 +10,10 @@
 #include <string.h>
 #include <stdio.h>
 #include <stdbool.h>
+#include <stddef.h>
 #include <stdint.h>
 #include <stdlib.h>
+#include <util/crc16.h>
 #include "onewire.h"
 #include "gpio.h"
 #include "usb.h"
@@ -38,17 +40,125 @@ volatile bool measure = false;
 volatile bool led_active;
 char output[256];
 
+// Host commands: 'A' selects the ASCII protocol, 'B' the binary protocol,
+// and 'R' followed by a byte between 1 and MAX_RATE sets the measurement rate in Hz
+#define COMMAND_ASCII 'A'
+#define COMMAND_BINARY 'B'
+#define COMMAND_RATE 'R'
+#define MAX_RATE 20
+
+// Timer1 ticks per second with the 1024 prescaler
+#define TIMER_FREQUENCY (F_CPU / 1024)
+
+#define FRAME_SYNC_0 0xA5
+#define FRAME_SYNC_1 0x5A
+
+// Binary frames are little-endian with temperature and humidity in hundredths
+// The CRC is CRC-16/CCITT (initial value 0xFFFF) over every byte after the sync word
+typedef struct
+{
+    uint8_t status;
+    uint8_t type;
+    int16_t temperature;
+    int16_t humidity;
+} __attribute__((packed)) frame_channel_t;
+
+typedef struct
+{
+    uint8_t sync[2];
+    uint16_t sequence;
+    uint8_t channel_count;
+    frame_channel_t channels[CHANNEL_COUNT];
+    uint16_t crc;
+} __attribute__((packed)) frame_t;
+
+bool binary = false;
+bool rate_pending = false;
+uint16_t sequence = 0;
+frame_t frame;
+
+static void set_rate(uint8_t rate)
+{
+    if (rate < 1 || rate > MAX_RATE)
+        return;
+
+    cli();
+    OCR1A = TIMER_FREQUENCY / rate - 1;
+    TCNT1 = 0;
+    sei();
+}
+
+static void read_commands(void)
+{
+    while (usb_can_read())
+    {
+        int16_t value = usb_read();
+        if (value < 0)
+            break;
+
+        if (rate_pending)
+        {
+            set_rate(value);
+            rate_pending = false;
+        }
+        else if (value == COMMAND_ASCII)
+            binary = false;
+        else if (value == COMMAND_BINARY)
+            binary = true;
+        else if (value == COMMAND_RATE)
+            rate_pending = true;
+    }
+}
+
+static int16_t scale(float value)
+{
+    return (int16_t)lroundf(value * 100);
+}
+
+static void write_binary(onewire_reading_t readings[CHANNEL_COUNT])
+{
+    frame.sync[0] = FRAME_SYNC_0;
+    frame.sync[1] = FRAME_SYNC_1;
+    frame.sequence = sequence++;
+    frame.channel_count = CHANNEL_COUNT;
+    for (uint8_t i = 0; i < CHANNEL_COUNT; i++)
+    {
+        frame.channels[i].status = readings[i].status;
+        frame.channels[i].type = readings[i].type;
+        frame.channels[i].temperature = scale(readings[i].temperature);
+        frame.channels[i].humidity = scale(readings[i].humidity);
+    }
+
+    uint16_t crc = 0xFFFF;
+    uint8_t* data = (uint8_t*)&frame;
+    for (uint8_t i = sizeof(frame.sync); i < offsetof(frame_t, crc); i++)
+        crc = _crc_xmodem_update(crc, data[i]);
+    frame.crc = crc;
+
+    usb_write_data(&frame, sizeof(frame));
+}
+
 static void loop(void)
 {
+    read_commands();
+
     if (measure)
     {
         measure = false;
+        onewire_reading_t readings[CHANNEL_COUNT];
         for (uint8_t i = 0; i < CHANNEL_COUNT; i++)
         {
-            sprintf(output, "%d:\r\n", i);
-            onewire_measure(&channels[i], output + 2);
-            usb_write_data(output, strlen(output));
+            onewire_measure(&channels[i], &readings[i]);
+            if (!binary)
+            {
+                sprintf(output, "%d:", i);
+                onewire_format(&readings[i], output + 2);
+                usb_write_data(output, strlen(output));
+            }
         }
+
+        if (binary)
+            write_binary(readings);
     }
 }
 
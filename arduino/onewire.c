@@ -162,7 +162,7 @@ static bool ds2438_read(const gpin_t* io, uint8_t page, uint8_t buffer[9])
     return true;
 }
 
-bool ds2438_measure(const gpin_t* io, char output[20])
+static bool ds2438_measure(const gpin_t* io, onewire_reading_t* reading)
 {
     uint8_t buffer[9];
     if (!onewire_reset(io))
@@ -226,7 +226,8 @@ bool ds2438_measure(const gpin_t* io, char output[20])
     float temperature = temp_integer + temp_frac / 1000.0f;
     float sensor_rh = (vad * 1.0f / vdd - 0.16f) / (0.0062f * (1.0546f - 0.00216f * temperature));
 
-    sprintf(output, "TH;%0.3f;%0.3f\r\n", temperature, sensor_rh);
+    reading->temperature = temperature;
+    reading->humidity = sensor_rh;
     return true;
 }
 
@@ -248,7 +249,7 @@ static bool ds1820_read(const gpin_t* io, uint8_t buffer[9])
     return true;
 }
 
-bool ds1820_measure(const gpin_t* io, char output[20], uint8_t bits)
+static bool ds1820_measure(const gpin_t* io, onewire_reading_t* reading)
 {
     uint8_t buffer[9];
     if (!onewire_reset(io))
@@ -260,28 +261,61 @@ bool ds1820_measure(const gpin_t* io, char output[20], uint8_t bits)
     if (!ds1820_read(io, buffer))
         return false;
 
-    if (bits == 9)
-        sprintf(output, "T;%0.1f\r\n", ((buffer[1] << 8) | buffer[0]) * 0.5f);
-    else
-        sprintf(output, "T;%0.3f\r\n", ((buffer[1] << 8) | buffer[0]) * 0.0625f);
+    // The scratchpad holds a signed two's complement value
+    const int16_t raw = (int16_t)((buffer[1] << 8) | buffer[0]);
+    reading->temperature = raw * (reading->bits == 9 ? 0.5f : 0.0625f);
     return true;
 }
 
-void onewire_measure(const gpin_t* io, char output[20])
+void onewire_measure(const gpin_t* io, onewire_reading_t* reading)
 {
+    reading->type = 0;
+    reading->bits = 0;
+    reading->temperature = 0;
+    reading->humidity = 0;
+
     if (!onewire_reset(io))
     {
-        strcpy(output, "NONE\r\n");
+        reading->status = ONEWIRE_STATUS_NONE;
         return;
     }
 
     onewire_write(io, 0x33);
-    uint8_t type = onewire_read(io);
-    switch (type)
+    reading->type = onewire_read(io);
+
+    bool success;
+    switch (reading->type)
+    {
+        case 0x10: reading->bits = 9; success = ds1820_measure(io, reading); break;
+        case 0x26: success = ds2438_measure(io, reading); break;
+        case 0x28: reading->bits = 12; success = ds1820_measure(io, reading); break;
+        default:
+            reading->status = ONEWIRE_STATUS_UNKNOWN;
+            return;
+    }
+
+    reading->status = success ? ONEWIRE_STATUS_OK : ONEWIRE_STATUS_ERROR;
+}
+
+void onewire_format(const onewire_reading_t* reading, char output[20])
+{
+    switch (reading->status)
     {
-        case 0x10: ds1820_measure(io, output, 9); break;
-        case 0x26: ds2438_measure(io, output); break;
-        case 0x28: ds1820_measure(io, output, 12); break;
-        default: sprintf(output, "UNKNOWN;0x%02X\r\n", type);
+        case ONEWIRE_STATUS_OK:
+            if (reading->type == 0x26)
+                sprintf(output, "TH;%0.3f;%0.3f\r\n", reading->temperature, reading->humidity);
+            else if (reading->bits == 9)
+                sprintf(output, "T;%0.1f\r\n", reading->temperature);
+            else
+                sprintf(output, "T;%0.3f\r\n", reading->temperature);
+            break;
+        case ONEWIRE_STATUS_NONE:
+            strcpy(output, "NONE\r\n");
+            break;
+        case ONEWIRE_STATUS_UNKNOWN:
+            sprintf(output, "UNKNOWN;0x%02X\r\n", reading->type);
+            break;
+        default:
+            strcpy(output, "\r\n");
     }
 }
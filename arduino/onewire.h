@@ -8,6 +8,21 @@
 #ifndef ONEWIRE_H
 #define ONEWIRE_H
 
-void onewire_measure(const gpin_t* io, char output[20]);
+#define ONEWIRE_STATUS_OK 0
+#define ONEWIRE_STATUS_NONE 1
+#define ONEWIRE_STATUS_UNKNOWN 2
+#define ONEWIRE_STATUS_ERROR 3
+
+typedef struct
+{
+    uint8_t status;
+    uint8_t type;
+    uint8_t bits;
+    float temperature;
+    float humidity;
+} onewire_reading_t;
+
+void onewire_measure(const gpin_t* io, onewire_reading_t* reading);
+void onewire_format(const onewire_reading_t* reading, char output[20]);
 
 #endif
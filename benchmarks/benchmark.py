@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs domealertd against stand-in hardware and measures:
+  - the latency from a new sample being available at its source to it being returned by the daemon
+  - the time taken to reopen the serial port after the device is replugged
+  - the CPU time used by the daemon for each sensor
+  - last_measurement throughput and latency with many concurrent Pyro clients
+"""
+
+import argparse
+import importlib.machinery
+import json
+import multiprocessing
+import os
+import random
+import signal
+import statistics
+import sys
+import tempfile
+import time
+import types
+import Pyro4
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from rockit.domealert import Config
+from fakes import FakeArduino, FakeW1Bus, MockGPIO
+
+# Use fork so that the daemon and clients do not need to re-import this script
+MP_CONTEXT = multiprocessing.get_context('fork')
+
+
+def process_cpu_time(pid):
+    """Returns the user + system CPU time used by a process in seconds"""
+    with open('/proc/{}/stat'.format(pid), 'r') as f_file:
+        # The process name may contain spaces, so split after its closing bracket
+        fields = f_file.read().rsplit(')', 1)[1].split()
+
+    # utime and stime are fields 14 and 15 of the stat line; fields[0] is field 3
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def daemon_cpu_time(pid):
+    """Returns the CPU time used by the daemon and any acquisition worker processes it has running"""
+    used = process_cpu_time(pid)
+    for task in os.listdir('/proc/{}/task'.format(pid)):
+        try:
+            with open('/proc/{}/task/{}/children'.format(pid, task), 'r') as f_file:
+                used += sum(process_cpu_time(int(child)) for child in f_file.read().split())
+        except FileNotFoundError:
+            # The thread or child exited while reading
+            pass
+    return used
+
+
+def summarize(samples):
+    """Returns latency percentiles in milliseconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {
+        'count': len(samples),
+        'mean': round(statistics.mean(samples) * 1000, 3),
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'max': round(samples[-1] * 1000, 3)
+    }
+
+
+def write_config(path, serial_port, w1_devices, poll_rate, workers, bulk_read):
+    config = {
+        'name': 'benchmark_domealert',
+        'acquisition_workers': workers,
+        'rj11_bulk_read': bulk_read,
+        'ip': '127.0.0.1',
+        'port': 0,
+        'sensor_poll_rate': poll_rate,
+        'sensor_timeout': 5 * poll_rate,
+
+        # Disable filtering so that every new sample is reflected immediately
+        'sensor_median_samples': 1,
+        'digital_serial_port': serial_port,
+        'digital_serial_baud': 9600,
+        'digital_serial_timeout': 3,
+        'digital': [
+            {'id': 'digital_temp', 'label': 'Temp', 'channel': 0, 'type': 'temperature'},
+            {'id': 'digital_humidity', 'label': 'Hum.', 'channel': 0, 'type': 'humidity'},
+            {'id': 'digital_probe', 'label': 'Probe', 'channel': 1, 'type': 'temperature'}
+        ],
+        'rj11': [
+            {'id': 'rj11_{}'.format(i), 'type': 't', 'device': d, 'label': d} for i, d in enumerate(w1_devices)
+        ],
+        'switches': [
+            {'id': 'switch_{}'.format(i), 'label': 'Switch', 'channel': i} for i in range(8)
+        ]
+    }
+
+    with open(path, 'w') as f_file:
+        json.dump(config, f_file)
+
+    return len(config['digital']) + len(config['rj11']) + len(config['switches'])
+
+
+def run_daemon(config_path, w1_path, verbose, threadpool_size, connection):
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')  # pylint: disable=consider-using-with
+
+    loader = importlib.machinery.SourceFileLoader('domealertd', os.path.join(REPO_PATH, 'domealertd'))
+    module = types.ModuleType(loader.name)
+    loader.exec_module(module)
+
+    Pyro4.config.REQUIRE_EXPOSE = True
+    Pyro4.config.THREADPOOL_SIZE = threadpool_size
+
+    # pylint: disable=no-member
+    daemon = module.DomeAlertDaemon(Config(config_path), gpio=MockGPIO(), w1_devices_path=w1_path)
+    pyro = Pyro4.Daemon(host='127.0.0.1', port=0)
+    uri = pyro.register(daemon, objectId='benchmark_domealert')
+    connection.send(str(uri))
+
+    # Stop any acquisition workers and release their shared memory when terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        pyro.requestLoop()
+    finally:
+        daemon.close()
+
+
+def run_client(uri, duration, barrier, queue):
+    latencies = []
+    with Pyro4.Proxy(uri) as proxy:
+        proxy._pyroBind()  # pylint: disable=protected-access
+        barrier.wait()
+
+        end = time.monotonic() + duration
+        while True:
+            start = time.monotonic()
+            if start > end:
+                break
+            proxy.last_measurement()
+            latencies.append(time.monotonic() - start)
+
+    queue.put(latencies)
+
+
+def measure_latency(proxy, field, set_value, samples, spread):
+    """
+    Changes the value of a sensor at its source and measures the time until it is
+    returned by wait_measurement. set_value(value) must return the monotonic time
+    that the value became available to the daemon.
+    """
+    latencies = []
+    sequence = proxy.wait_measurement(0, 0, [field])['sequence']
+    for i in range(samples):
+        value = 10 + (i % 40) * 0.5
+
+        # Desynchronise changes from the daemon's poll schedule
+        time.sleep(random.uniform(0, spread))
+        changed = set_value(value)
+        while True:
+            response = proxy.wait_measurement(sequence, 10, [field])
+            sequence = response['sequence']
+            measurement = response['measurement']
+            if measurement[field + '_valid'] and abs(measurement[field] - value) < 0.01:
+                break
+
+            if time.monotonic() - changed > 10:
+                raise RuntimeError('timed out waiting for ' + field + ' to update')
+
+        latencies.append(time.monotonic() - changed)
+
+    return summarize(latencies)
+
+
+def serial_connects(proxy):
+    # Acquisition workers report their metrics to the daemon with each heartbeat,
+    # so with --workers this adds up to workers.HEARTBEAT_INTERVAL to the reconnection time
+    counters = proxy.stats()['metrics'].get('domealert_serial_connects_total', [])
+    return sum(c['value'] for c in counters)
+
+
+def measure_reconnect(proxy, arduino, count):
+    """Unplugs and replugs the fake Arduino and measures the time until the daemon reopens the port"""
+    latencies = []
+    for _ in range(count):
+        connects = serial_connects(proxy)
+        arduino.unplug()
+
+        # Give the daemon time to notice the disconnection and start retrying
+        time.sleep(random.uniform(0.5, 2))
+        replugged = arduino.replug()
+        while serial_connects(proxy) == connects:
+            if time.monotonic() - replugged > 30:
+                raise RuntimeError('timed out waiting for the serial port to reconnect')
+            time.sleep(0.001)
+
+        latencies.append(time.monotonic() - replugged)
+
+    return summarize(latencies)
+
+
+def measure_cpu(pid, duration, sensor_count):
+    start_cpu = daemon_cpu_time(pid)
+    start = time.monotonic()
+    time.sleep(duration)
+    used = daemon_cpu_time(pid) - start_cpu
+    elapsed = time.monotonic() - start
+
+    return {
+        'sensors': sensor_count,
+        'cpu_percent': round(100 * used / elapsed, 3),
+        'cpu_ms_per_sensor_second': round(1000 * used / elapsed / sensor_count, 3)
+    }
+
+
+def measure_throughput(uri, pid, clients, duration):
+    barrier = MP_CONTEXT.Barrier(clients + 1)
+    queue = MP_CONTEXT.Queue()
+    processes = [MP_CONTEXT.Process(target=run_client, args=(uri, duration, barrier, queue), daemon=True)
+                 for _ in range(clients)]
+    for process in processes:
+        process.start()
+
+    barrier.wait()
+    start_cpu = daemon_cpu_time(pid)
+    latencies = []
+    for _ in processes:
+        latencies.extend(queue.get())
+    used = daemon_cpu_time(pid) - start_cpu
+
+    for process in processes:
+        process.join()
+
+    return {
+        'clients': clients,
+        'calls_per_second': round(len(latencies) / duration, 1),
+        'daemon_cpu_percent': round(100 * used / duration, 3),
+        'latency_ms': summarize(latencies)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark domealertd against stand-in hardware')
+    parser.add_argument('--rj11', type=int, default=8, help='number of fake DS18B20 sensors (default: 8)')
+    parser.add_argument('--poll-rate', type=float, default=1, help='sensor poll interval in seconds (default: 1)')
+    parser.add_argument('--serial-rate', type=float, default=1, help='fake Arduino frames per second (default: 1)')
+    parser.add_argument('--samples', type=int, default=20, help='latency samples per source (default: 20)')
+    parser.add_argument('--reconnects', type=int, default=5, help='serial reconnection samples (default: 5)')
+    parser.add_argument('--cpu-duration', type=float, default=10, help='CPU measurement time (default: 10s)')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32],
+                        help='concurrent Pyro client counts (default: 1 8 32)')
+    parser.add_argument('--client-duration', type=float, default=5, help='time for each client run (default: 5s)')
+    parser.add_argument('--workers', action='store_true', help='run the acquisition in worker processes')
+    parser.add_argument('--bulk-read', action='store_true', help='read the rj11 sensors using bulk conversions')
+    parser.add_argument('--conversion-time', type=float, default=0.75,
+                        help='fake bulk conversion time (default: 0.75s, use >1.5s to exercise the timeout)')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the daemon output')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        bus = FakeW1Bus(os.path.join(path, 'w1'), args.rj11, args.conversion_time)
+        serial_port = os.path.join(path, 'ttyARDUINO')
+        config_path = os.path.join(path, 'config.json')
+        sensor_count = write_config(config_path, serial_port, bus.devices, args.poll_rate, args.workers,
+                                    args.bulk_read)
+
+        receiver, sender = MP_CONTEXT.Pipe(duplex=False)
+        # Not daemonic, so that it may start acquisition worker processes. It is terminated below
+        daemon = MP_CONTEXT.Process(target=run_daemon,
+                                    args=(config_path, bus.path, args.verbose, max(args.clients) + 8, sender))
+        daemon.start()
+        uri = receiver.recv()
+
+        # The daemon must not inherit the pseudo-terminal, otherwise it can't be unplugged
+        arduino = FakeArduino(serial_port, args.serial_rate)
+
+        try:
+            with Pyro4.Proxy(uri) as proxy:
+                # Wait for every sensor to report before measuring
+                deadline = time.monotonic() + 30
+                while not all(v for k, v in proxy.last_measurement().items() if k.endswith('_valid')):
+                    if time.monotonic() > deadline:
+                        raise RuntimeError('sensors did not become valid')
+                    time.sleep(0.1)
+
+                def set_rj11(value):
+                    bus.set_temperature(bus.devices[0], value)
+                    return time.monotonic()
+
+                print('Measuring sample-to-export latency...')
+                results['latency_ms'] = {
+                    'rj11': measure_latency(proxy, 'rj11_0', set_rj11, args.samples, args.poll_rate),
+                    'serial': measure_latency(proxy, 'digital_temp', lambda v: arduino.set_values(v, 50),
+                                              args.samples, 0)
+                }
+
+                print('Measuring serial reconnection time...')
+                results['reconnect_ms'] = measure_reconnect(proxy, arduino, args.reconnects)
+
+            print('Measuring idle CPU usage...')
+            results['cpu'] = measure_cpu(daemon.pid, args.cpu_duration, sensor_count)
+
+            results['throughput'] = []
+            for clients in args.clients:
+                print('Measuring last_measurement throughput with {} clients...'.format(clients))
+                results['throughput'].append(measure_throughput(uri, daemon.pid, clients, args.client_duration))
+
+            results['bulk_conversions'] = bus.conversions
+        finally:
+            daemon.terminate()
+            daemon.join()
+            arduino.close()
+            bus.close()
+
+    print()
+    for source, summary in results['latency_ms'].items():
+        print('{} sample-to-export latency (ms): {}'.format(source, summary))
+
+    print('serial reconnection time (ms): {}'.format(results['reconnect_ms']))
+    if args.bulk_read:
+        print('rj11 bulk conversions: {}'.format(results['bulk_conversions']))
+
+    cpu = results['cpu']
+    print('Idle CPU: {}% for {} sensors ({} ms per sensor per second)'.format(
+        cpu['cpu_percent'], cpu['sensors'], cpu['cpu_ms_per_sensor_second']))
+
+    for run in results['throughput']:
+        print('{:>4} clients: {:>9} calls/s, daemon CPU {}%, latency (ms): {}'.format(
+            run['clients'], run['calls_per_second'], run['daemon_cpu_percent'], run['latency_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as f_file:
+            json.dump(results, f_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
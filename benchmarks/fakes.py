@@ -0,0 +1,208 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Stand-ins for the 1-wire sysfs tree, the Arduino serial port and RPi.GPIO"""
+
+import os
+import pty
+import threading
+import time
+import tty
+
+
+class FakeW1Bus:
+    """
+    Creates a directory that mimics /sys/bus/w1/devices with a single bus master
+    and a number of DS18B20 sensors whose temperatures can be set at any time.
+    Writing trigger to therm_bulk_read starts a simulated conversion that
+    reads as -1 for conversion_time seconds.
+    """
+    def __init__(self, path, device_count, conversion_time=0.75):
+        self.path = path
+        self.devices = ['28-{:012x}'.format(i + 1) for i in range(device_count)]
+        self.conversions = 0
+        self._conversion_time = conversion_time
+        self._files = {}
+        self._closed = False
+
+        bus_path = os.path.join(path, 'w1_bus_master1')
+        os.makedirs(bus_path)
+        self._bulk_read_path = os.path.join(bus_path, 'therm_bulk_read')
+        self.__set_bulk_read('1')
+
+        for device in self.devices:
+            hwmon_path = os.path.join(path, device, 'hwmon', 'hwmon0')
+            os.makedirs(hwmon_path)
+            os.symlink(os.path.join('..', device), os.path.join(bus_path, device))
+
+            # The hwmon and bulk read attributes report the same value
+            input_path = os.path.join(hwmon_path, 'temp1_input')
+            os.symlink(input_path, os.path.join(path, device, 'temperature'))
+            self._files[device] = os.open(input_path, os.O_RDWR | os.O_CREAT)
+            self.set_temperature(device, 20)
+
+        threading.Thread(target=self.__run_conversions, daemon=True).start()
+
+    def set_temperature(self, device, temperature):
+        # The daemon keeps the attribute files open and re-reads them from the start,
+        # so values must be rewritten in place (as a fixed width field) rather than replaced
+        os.pwrite(self._files[device], '{:>10d}\n'.format(int(round(temperature * 1000))).encode('ascii'), 0)
+
+    def __set_bulk_read(self, value):
+        # Replaced atomically so that the daemon never reads a partially written file
+        temp_path = self._bulk_read_path + '.tmp'
+        with open(temp_path, 'w') as f_file:
+            f_file.write(value + '\n')
+        os.replace(temp_path, self._bulk_read_path)
+
+    def __run_conversions(self):
+        try:
+            while not self._closed:
+                with open(self._bulk_read_path, 'r') as f_file:
+                    triggered = f_file.read().strip() == 'trigger'
+
+                if triggered:
+                    self.__set_bulk_read('-1')
+                    time.sleep(self._conversion_time)
+                    self.__set_bulk_read('1')
+                    self.conversions += 1
+
+                time.sleep(0.005)
+        except FileNotFoundError:
+            # The tree has been removed after close()
+            if not self._closed:
+                raise
+
+    def close(self):
+        self._closed = True
+        for fd in self._files.values():
+            os.close(fd)
+
+
+class FakeArduino:
+    """
+    Emits the Arduino text protocol on a pseudo-terminal from a background thread.
+    The port is exposed through a symlink (like a udev rule would create) so that
+    the device can be unplugged and replugged as a new pseudo-terminal.
+    """
+    def __init__(self, port, rate=1):
+        self.port = port
+        self._rate = rate
+        self._lock = threading.Lock()
+        self._temperature = 20.0
+        self._humidity = 50.0
+        self._sent = None
+        self._sent_time = None
+        self._master = None
+        self._slave = None
+        self._closed = False
+        self.replug()
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def unplug(self):
+        """Removes the port and closes the pseudo-terminal, causing reads in the daemon to fail"""
+        with self._lock:
+            if self._master is not None:
+                os.unlink(self.port)
+                os.close(self._master)
+                os.close(self._slave)
+                self._master = self._slave = None
+
+    def replug(self):
+        """Creates a new pseudo-terminal and links the port to it. Returns the time that the port appeared"""
+        with self._lock:
+            master, slave = pty.openpty()
+            tty.setraw(slave)
+            self._master, self._slave = master, slave
+            os.symlink(os.ttyname(slave), self.port)
+            return time.monotonic()
+
+    def set_values(self, temperature, humidity):
+        """Sets the values reported on channel 0. Returns the time that they are written to the port"""
+        with self._lock:
+            self._temperature = temperature
+            self._humidity = humidity
+            self._sent = threading.Event()
+            sent = self._sent
+
+        sent.wait()
+        return self._sent_time
+
+    def __run(self):
+        while not self._closed:
+            with self._lock:
+                if self._master is not None:
+                    frame = '0:TH;{:.3f};{:.3f}\r\n1:T;{:.3f}\r\n2:NONE\r\n3:\r\n'.format(
+                        self._temperature, self._humidity, self._temperature)
+                    os.write(self._master, frame.encode('ascii'))
+                    if self._sent is not None:
+                        self._sent_time = time.monotonic()
+                        self._sent.set()
+                        self._sent = None
+
+            time.sleep(1. / self._rate)
+
+    def close(self):
+        self._closed = True
+        self.unplug()
+
+
+class MockGPIO:
+    """Implements the subset of the RPi.GPIO interface used by SwitchSensorsWatcher"""
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    BOTH = 33
+
+    def __init__(self):
+        self._levels = {}
+        self._callbacks = {}
+
+    def setwarnings(self, _):
+        pass
+
+    def setmode(self, _):
+        pass
+
+    def setup(self, pins, direction):
+        if not isinstance(pins, (list, tuple)):
+            pins = [pins]
+        for pin in pins:
+            # Switch inputs are pulled up, so idle high
+            self._levels.setdefault(pin, self.HIGH if direction == self.IN else self.LOW)
+
+    def input(self, pin):
+        return self._levels[pin]
+
+    def output(self, pin, value):
+        self._levels[pin] = self.HIGH if value else self.LOW
+
+    def add_event_detect(self, pin, _, callback=None):
+        self._callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def set_input(self, pin, level):
+        """Changes the level of an input pin, invoking any edge callback"""
+        if self._levels.get(pin) != level:
+            self._levels[pin] = level
+            callback = self._callbacks.get(pin)
+            if callback is not None:
+                callback(pin)
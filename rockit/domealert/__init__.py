@@ -16,7 +16,18 @@
 
 """domealertd common code"""
 
+from .client import DomeAlertClient
 from .config import Config
+from .derived import DerivedSensorsWatcher
 from .digitalsensors import DigitalSensorsWatcher
+from .history import MeasurementHistory
+from .measurements import MeasurementStore
+from .metrics import Metrics, MetricsServer
+from .samplelog import SampleLog, SampleLogReader, query_logs
+from .rules import RuleEngine
+from .scheduler import AcquisitionScheduler
+from .state import StateCheckpoint, load_state
+from .subscriptions import SubscriptionManager
 from .switchsensors import SwitchSensorsWatcher
 from .rj11sensors import RJ11SensorsWatcher
+from .workers import AcquisitionWorker
@@ -0,0 +1,163 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Client for querying several domealertd instances at once"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import datetime
+import os
+import threading
+import Pyro4
+from .config import Config
+
+
+class DaemonConnection:
+    """A persistent proxy to a single daemon, along with its cached sensor definitions"""
+    def __init__(self, name, uri, timeout):
+        self.name = name
+        self.uri = uri
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._proxy = None
+        self._sensors = None
+        self._generation = None
+
+    def query(self):
+        """Returns a tuple of (sensor definitions, measurement). Must be called with self.lock held"""
+        try:
+            if self._proxy is None:
+                self._proxy = Pyro4.Proxy(self.uri)
+                self._proxy._pyroTimeout = self.timeout  # pylint: disable=protected-access
+
+            # Sensor definitions only change when the daemon reloads its configuration,
+            # so are only refetched when its config generation changes.
+            # The generation is batched with the measurement to keep a single round trip
+            batch = Pyro4.batch(self._proxy)
+            batch.config_generation()
+            batch.last_measurement()
+            generation, measurement = batch()
+
+            if self._sensors is None or generation != self._generation:
+                self._sensors = self._proxy.measurement_sensors()
+                self._generation = generation
+
+            return self._sensors, measurement
+        except Exception:
+            self.release()
+            raise
+
+    def release(self):
+        if self._proxy is not None:
+            self._proxy._pyroRelease()  # pylint: disable=protected-access
+            self._proxy = None
+        self._sensors = None
+        self._generation = None
+
+
+class DomeAlertClient:
+    """
+    Queries a set of daemons concurrently through persistent Pyro proxies,
+    and merges their measurements into a single labelled snapshot.
+
+    daemons is a dictionary of name to Pyro URI. Each daemon must respond within
+    timeout seconds; daemons that are slow or unreachable are reported as unavailable
+    without delaying the others. A daemon that is still busy with an earlier
+    query is skipped until it completes.
+    """
+    def __init__(self, daemons, timeout=5):
+        self._timeout = timeout
+        self._connections = [DaemonConnection(name, uri, timeout) for name, uri in daemons.items()]
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self._connections)),
+                                            thread_name_prefix='domealert-client')
+
+    @classmethod
+    def from_config_files(cls, config_filenames, timeout=5):
+        """Creates a client for the daemons defined by a list of config files, named after each file"""
+        daemons = {}
+        for filename in config_filenames:
+            config = Config(filename)
+            name = os.path.splitext(os.path.basename(filename))[0]
+            daemons[name] = 'PYRO:{}@{}:{}'.format(config.name, config.ip, config.port)
+        return cls(daemons, timeout)
+
+    @staticmethod
+    def __query(connection):
+        if not connection.lock.acquire(blocking=False):
+            raise TimeoutError('previous query has not completed')
+
+        try:
+            return connection.query()
+        finally:
+            connection.lock.release()
+
+    def measurement(self):
+        """
+        Returns a dictionary with the status of each daemon under 'daemons' and
+        each sensor under 'sensors', keyed by '<daemon name>.<sensor id>'
+        """
+        futures = {self._executor.submit(self.__query, c): c for c in self._connections}
+        done, _ = wait(futures, timeout=self._timeout)
+
+        daemons = {}
+        sensors = {}
+        for future, connection in futures.items():
+            if future not in done:
+                # The query will continue in the background until the proxy times out
+                daemons[connection.name] = {'available': False, 'error': 'timed out'}
+                continue
+
+            try:
+                definitions, measurement = future.result()
+            except Exception as exception:
+                daemons[connection.name] = {'available': False, 'error': str(exception) or type(exception).__name__}
+                continue
+
+            daemons[connection.name] = {'available': True, 'date': measurement['date']}
+            for sensor_id, value in measurement.items():
+                if sensor_id == 'date' or sensor_id.endswith('_valid'):
+                    continue
+
+                sensor = dict(definitions.get(sensor_id, {}))
+                sensor.setdefault('label', sensor_id)
+                sensor.update({
+                    'daemon': connection.name,
+                    'id': sensor_id,
+                    'value': value,
+                    'valid': measurement.get(sensor_id + '_valid', False)
+                })
+                sensors[connection.name + '.' + sensor_id] = sensor
+
+        return {
+            'date': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'daemons': daemons,
+            'sensors': sensors
+        }
+
+    def close(self):
+        """Releases the proxies. Queries that are still in progress are left to time out"""
+        self._executor.shutdown(wait=False)
+        for connection in self._connections:
+            if connection.lock.acquire(blocking=False):
+                try:
+                    connection.release()
+                finally:
+                    connection.lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -20,6 +20,74 @@ import json
 import sys
 import traceback
 import jsonschema
+from .derived import DERIVED_SENSOR_COUNT
+from .protocol import CHANNEL_COUNT
+
+FILTERS_SCHEMA = {
+    'type': 'array',
+    'minItems': 1,
+    'items': {
+        'type': 'object',
+        'additionalProperties': False,
+        'required': ['type'],
+        'properties': {
+            'type': {
+                'type': 'string',
+                'enum': ['median', 'ema', 'hampel']
+            },
+            'window': {
+                'type': 'integer',
+                'minimum': 1
+            },
+            'alpha': {
+                'type': 'number',
+                'exclusiveMinimum': True,
+                'minimum': 0,
+                'maximum': 1
+            },
+            'threshold': {
+                'type': 'number',
+                'exclusiveMinimum': True,
+                'minimum': 0
+            }
+        }
+    }
+}
+
+# Backs off the poll interval of an rj11 sensor while its value is stable
+ADAPTIVE_SCHEMA = {
+    'type': 'object',
+    'additionalProperties': False,
+    'required': ['max_poll_rate', 'change'],
+    'properties': {
+        # Slowest poll interval in seconds
+        'max_poll_rate': {
+            'type': 'number',
+            'minimum': 0.1,
+            'maximum': 3600
+        },
+        # Change between consecutive raw or filtered values that returns to the fastest rate
+        'change': {
+            'type': 'number',
+            'exclusiveMinimum': True,
+            'minimum': 0
+        },
+        # Values within limit_margin of limit are also polled at the fastest rate
+        'limit': {
+            'type': 'number'
+        },
+        'limit_margin': {
+            'type': 'number',
+            'minimum': 0
+        }
+    }
+}
+
+# Maximum number of channels on a digital board
+MAX_DIGITAL_CHANNELS = 16
+
+# Board id used for the legacy digital_serial_* settings
+DEFAULT_DIGITAL_BOARD = 'default'
 
 CONFIG_SCHEMA = {
     'type': 'object',
@@ -40,6 +108,11 @@ CONFIG_SCHEMA = {
             'min': 0,
             'max': 65535
         },
+        'metrics_port': {
+            'type': 'integer',
+            'min': 0,
+            'max': 65535
+        },
         'digital_serial_port': {
             'type': 'string',
         },
@@ -51,6 +124,53 @@ CONFIG_SCHEMA = {
             'type': 'number',
             'min': 0
         },
+        'digital_serial_protocol': {
+            'type': 'string',
+            'enum': ['ascii', 'binary']
+        },
+        'digital_serial_rate': {
+            'type': 'integer',
+            'minimum': 1,
+            'maximum': 20
+        },
+        'digital_boards': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'additionalProperties': False,
+                'required': ['id', 'serial_port', 'serial_baud', 'serial_timeout'],
+                'properties': {
+                    'id': {
+                        'type': 'string'
+                    },
+                    'serial_port': {
+                        'type': 'string'
+                    },
+                    'serial_baud': {
+                        'type': 'number',
+                        'minimum': 0
+                    },
+                    'serial_timeout': {
+                        'type': 'number',
+                        'minimum': 0
+                    },
+                    'serial_protocol': {
+                        'type': 'string',
+                        'enum': ['ascii', 'binary']
+                    },
+                    'serial_rate': {
+                        'type': 'integer',
+                        'minimum': 1,
+                        'maximum': 20
+                    },
+                    'channels': {
+                        'type': 'integer',
+                        'minimum': 1,
+                        'maximum': MAX_DIGITAL_CHANNELS
+                    }
+                }
+            }
+        },
         'sensor_poll_rate': {
             'type': 'number',
             'min': 1,
@@ -64,7 +184,56 @@ CONFIG_SCHEMA = {
         'sensor_median_samples': {
             'type': 'number',
             'min': 0,
-            'max': 120
+            'max': 3600
+        },
+        'history_duration': {
+            'type': 'number',
+            'minimum': 60
+        },
+        'history_interval': {
+            'type': 'number',
+            'exclusiveMinimum': True,
+            'minimum': 0
+        },
+        'sample_log_path': {
+            'type': 'string'
+        },
+        'sample_log_max_size': {
+            'type': 'integer',
+            'minimum': 4096
+        },
+        'sample_log_max_files': {
+            'type': 'integer',
+            'minimum': 1
+        },
+        'sample_log_fsync_interval': {
+            'type': 'number',
+            'minimum': 0
+        },
+        'state_path': {
+            'type': 'string'
+        },
+        'state_interval': {
+            'type': 'number',
+            'minimum': 1
+        },
+        'state_max_age': {
+            'type': 'number',
+            'minimum': 0
+        },
+        'rj11_bulk_read': {
+            'type': 'boolean'
+        },
+        'acquisition_workers': {
+            'type': 'boolean'
+        },
+        'switch_edge_detect': {
+            'type': 'boolean'
+        },
+        'switch_debounce': {
+            'type': 'number',
+            'minimum': 1,
+            'maximum': 1000
         },
         'digital': {
             'type': 'array',
@@ -80,17 +249,21 @@ CONFIG_SCHEMA = {
                         'type': 'string',
                         'enum': ['temperature', 'humidity']
                     },
+                    'board': {
+                        'type': 'string'
+                    },
                     'channel': {
                         'type': 'integer',
                         'minimum': 0,
-                        'maximum': 3
+                        'maximum': MAX_DIGITAL_CHANNELS - 1
                     },
                     'label': {
                         'type': 'string',
                     },
                     'units': {
                         'type': 'string',
-                    }
+                    },
+                    'filters': FILTERS_SCHEMA
                 }
             }
         },
@@ -116,7 +289,14 @@ CONFIG_SCHEMA = {
                     },
                     'units': {
                         'type': 'string',
-                    }
+                    },
+                    'filters': FILTERS_SCHEMA,
+                    'poll_rate': {
+                        'type': 'number',
+                        'minimum': 0.1,
+                        'maximum': 3600
+                    },
+                    'adaptive': ADAPTIVE_SCHEMA
                 }
             }
         },
@@ -148,13 +328,95 @@ CONFIG_SCHEMA = {
                     }
                 }
             }
+        },
+        'derived': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'additionalProperties': False,
+                'required': ['id', 'type', 'sensors', 'label'],
+                'properties': {
+                    'id': {
+                        'type': 'string',
+                    },
+                    'type': {
+                        'type': 'string',
+                        'enum': ['dewpoint', 'difference', 'rate']
+                    },
+                    'sensors': {
+                        'type': 'array',
+                        'minItems': 1,
+                        'maxItems': 2,
+                        'items': {
+                            'type': 'string'
+                        }
+                    },
+                    'window': {
+                        'type': 'number',
+                        'exclusiveMinimum': True,
+                        'minimum': 0
+                    },
+                    'label': {
+                        'type': 'string',
+                    },
+                    'units': {
+                        'type': 'string',
+                    }
+                }
+            }
+        },
+        'rules': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'additionalProperties': False,
+                'required': ['id', 'sensor', 'condition'],
+                'properties': {
+                    'id': {
+                        'type': 'string',
+                    },
+                    'label': {
+                        'type': 'string',
+                    },
+                    'sensor': {
+                        'type': 'string',
+                    },
+                    'condition': {
+                        'type': 'string',
+                        'enum': ['above', 'below', 'equals']
+                    },
+                    'threshold': {
+                        'type': 'number'
+                    },
+                    'hysteresis': {
+                        'type': 'number',
+                        'minimum': 0
+                    },
+                    'value': {
+                        'type': ['number', 'boolean']
+                    },
+                    'hold': {
+                        'type': 'number',
+                        'minimum': 0
+                    },
+                    # How the rule behaves while its sensor has no valid value
+                    'invalid': {
+                        'type': 'string',
+                        'enum': ['trigger', 'clear', 'hold']
+                    },
+                    'relay': {
+                        'type': 'boolean'
+                    }
+                }
+            }
         }
     },
     'dependencies': {
-        'digital': ['digital_serial_port', 'digital_serial_baud', 'digital_serial_timeout'],
         'digital_serial_port': ['digital_serial_baud', 'digital_serial_timeout'],
         'digital_serial_baud': ['digital_serial_port', 'digital_serial_timeout'],
-        'digital_serial_timeout': ['digital_serial_baud', 'digital_serial_baud']
+        'digital_serial_timeout': ['digital_serial_baud', 'digital_serial_baud'],
+        'digital_serial_protocol': ['digital_serial_port'],
+        'digital_serial_rate': ['digital_serial_port']
     }
 }
 
@@ -196,11 +458,85 @@ def validate_config(config_json):
         traceback.print_exc(file=sys.stdout)
         errors = ['exception while validating']
 
+    if not errors:
+        errors = validate_references(config_json)
+
     if errors:
         raise ConfigSchemaViolationError(errors)
 
 
-class Config:
+def validate_references(config_json):  # pylint: disable=too-many-branches
+    """
+    Returns a list of errors for digital sensors that reference unknown boards or channels,
+    derived sensors that don't reference the correct number of measured sensors,
+    and rules that reference unknown sensors or lack a threshold or value
+    """
+    errors = []
+    boards = {}
+    for i, board in enumerate(parse_digital_boards(config_json)):
+        if board['id'] in boards:
+            errors.append('digital_boards->{}: duplicate board id \'{}\''.format(i, board['id']))
+        boards.setdefault(board['id'], board)
+
+    for i, sensor in enumerate(config_json.get('digital', [])):
+        path = 'digital->' + str(i)
+        if not boards:
+            errors.append(path + ': digital sensors require digital_serial_port or digital_boards')
+            continue
+
+        board = boards.get(sensor.get('board', next(iter(boards))))
+        if board is None:
+            errors.append('{}->board: \'{}\' is not a digital board'.format(path, sensor['board']))
+        elif sensor['channel'] >= board['channels']:
+            errors.append('{}->channel: board \'{}\' has {} channels'.format(path, board['id'], board['channels']))
+    measured = {s['id'] for s in config_json.get('digital', []) + config_json.get('rj11', [])}
+    for i, derived in enumerate(config_json.get('derived', [])):
+        path = 'derived->' + str(i)
+        count = DERIVED_SENSOR_COUNT[derived['type']]
+        if len(derived['sensors']) != count:
+            errors.append('{}->sensors: {} requires {} sensor(s)'.format(path, derived['type'], count))
+
+        for sensor_id in derived['sensors']:
+            if sensor_id not in measured:
+                errors.append('{}->sensors: \'{}\' is not a digital or rj11 sensor'.format(path, sensor_id))
+
+    sensors = measured | {s['id'] for s in config_json.get('switches', []) + config_json.get('derived', [])}
+    for i, rule in enumerate(config_json.get('rules', [])):
+        path = 'rules->' + str(i)
+        if rule['sensor'] not in sensors:
+            errors.append('{}->sensor: \'{}\' is not a known sensor'.format(path, rule['sensor']))
+
+        required = 'value' if rule['condition'] == 'equals' else 'threshold'
+        if required not in rule:
+            errors.append('{}: \'{}\' is required for \'{}\' rules'.format(path, required, rule['condition']))
+
+    return errors
+
+
+def parse_digital_boards(config_json):
+    """Returns the list of digital boards with defaults filled in, starting with any defined by the legacy settings"""
+    boards = []
+    if 'digital_serial_port' in config_json:
+        boards.append({
+            'id': DEFAULT_DIGITAL_BOARD,
+            'serial_port': config_json['digital_serial_port'],
+            'serial_baud': config_json['digital_serial_baud'],
+            'serial_timeout': config_json['digital_serial_timeout'],
+            'serial_protocol': config_json.get('digital_serial_protocol', 'ascii'),
+            'serial_rate': config_json.get('digital_serial_rate', 1)
+        })
+
+    for board in config_json.get('digital_boards', []):
+        boards.append(dict(board))
+
+    for board in boards:
+        board.setdefault('serial_protocol', 'ascii')
+        board.setdefault('serial_rate', 1)
+        board.setdefault('channels', CHANNEL_COUNT)
+    return boards
+
+
+class Config:  # pylint: disable=too-many-instance-attributes
     """Daemon configuration parsed from a json file"""
     def __init__(self, config_filename):
         # Will throw on file not found or invalid json
@@ -210,15 +546,35 @@ class Config:
         # Will throw on schema violations
         validate_config(config_json)
 
+        self.filename = config_filename
         self.name = config_json['name']
         self.ip = config_json['ip']
         self.port = config_json['port']
+        self.metrics_port = config_json.get('metrics_port', None)
         self.sensor_poll_rate = config_json['sensor_poll_rate']
         self.sensor_median_samples = config_json['sensor_median_samples']
         self.sensor_timeout = config_json['sensor_timeout']
+        self.history_duration = config_json.get('history_duration', 86400)
+        self.history_interval = config_json.get('history_interval', self.sensor_poll_rate)
+        self.sample_log_path = config_json.get('sample_log_path', None)
+        self.sample_log_max_size = config_json.get('sample_log_max_size', 16 * 1024 * 1024)
+        self.sample_log_max_files = config_json.get('sample_log_max_files', 64)
+        self.sample_log_fsync_interval = config_json.get('sample_log_fsync_interval', 10)
+        self.state_path = config_json.get('state_path', None)
+        self.state_interval = config_json.get('state_interval', 30)
+        self.state_max_age = config_json.get('state_max_age', 600)
         self.digital_serial_port = config_json.get('digital_serial_port', None)
         self.digital_serial_baud = config_json.get('digital_serial_baud', 0)
         self.digital_serial_timeout = config_json.get('digital_serial_timeout', 0)
+        self.digital_serial_protocol = config_json.get('digital_serial_protocol', 'ascii')
+        self.digital_serial_rate = config_json.get('digital_serial_rate', 1)
+        self.digital_boards = parse_digital_boards(config_json)
         self.digital_sensors = config_json.get('digital', [])
         self.rj11_sensors = config_json.get('rj11', [])
+        self.rj11_bulk_read = config_json.get('rj11_bulk_read', False)
+        self.acquisition_workers = config_json.get('acquisition_workers', False)
         self.switch_sensors = config_json.get('switches', [])
+        self.switch_edge_detect = config_json.get('switch_edge_detect', False)
+        self.switch_debounce = config_json.get('switch_debounce', 20)
+        self.derived_sensors = config_json.get('derived', [])
+        self.rules = config_json.get('rules', [])
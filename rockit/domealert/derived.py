@@ -0,0 +1,168 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Quantities derived from other sensors as their samples arrive"""
+
+from collections import deque
+import math
+import threading
+import time
+
+# Magnus formula coefficients (Alduchov & Eskridge 1996), valid for -40 to 50 C over water
+MAGNUS_B = 17.625
+MAGNUS_C = 243.04
+
+# Number of sensors used by each derived type
+DERIVED_SENSOR_COUNT = {
+    'dewpoint': 2,
+    'difference': 2,
+    'rate': 1
+}
+
+
+def dew_point(temperature, humidity):
+    """Returns the dew point in degrees C for a temperature in degrees C and relative humidity in percent"""
+    gamma = math.log(max(humidity, 0.01) / 100) + MAGNUS_B * temperature / (MAGNUS_C + temperature)
+    return MAGNUS_C * gamma / (MAGNUS_B - gamma)
+
+
+class DewPoint:
+    """Dew point from a temperature sensor and a relative humidity sensor"""
+    def __init__(self, _):
+        pass
+
+    @staticmethod
+    def update(values, _):
+        return dew_point(values[0], values[1])
+
+
+class Difference:
+    """The value of the first sensor minus the second"""
+    def __init__(self, _):
+        pass
+
+    @staticmethod
+    def update(values, _):
+        return values[0] - values[1]
+
+
+class RateOfChange:
+    """
+    The change in a sensor value per hour, from a linear fit to the samples in the last window seconds.
+    Returns None until the samples span at least half of the window.
+    """
+    def __init__(self, config):
+        self._window = config.get('window', 600)
+        self._samples = deque()
+
+    def update(self, values, timestamp):
+        self._samples.append((timestamp, values[0]))
+        while self._samples[0][0] < timestamp - self._window:
+            self._samples.popleft()
+
+        if timestamp - self._samples[0][0] < self._window / 2:
+            return None
+
+        count = len(self._samples)
+        mean_t = sum(t for t, _ in self._samples) / count
+        mean_v = sum(v for _, v in self._samples) / count
+        variance = sum((t - mean_t) ** 2 for t, _ in self._samples)
+        if variance <= 0:
+            return None
+
+        covariance = sum((t - mean_t) * (v - mean_v) for t, v in self._samples)
+        return 3600 * covariance / variance
+
+
+DERIVED_TYPES = {
+    'dewpoint': DewPoint,
+    'difference': Difference,
+    'rate': RateOfChange
+}
+
+
+class DerivedSensorsWatcher:
+    """
+    Computes derived values as a MeasurementStore listener whenever one of their sensors is updated,
+    and publishes them to the same store. A derived value is valid until the earliest of its
+    sensors times out.
+    """
+    def __init__(self, config, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._sensors = {}
+
+        # sensor id -> list of derived ids that use it
+        self._dependents = {}
+
+        # sensor id -> latest (value, unix timestamp, monotonic expiry time)
+        self._inputs = {}
+
+        self.reconfigure(config)
+        store.add_listener(self.__sensors_updated)
+
+    def reconfigure(self, config):
+        """Applies a new set of derived sensor definitions. Unchanged sensors keep their state"""
+        with self._lock:
+            definitions = {s['id']: (s['type'], tuple(s['sensors']), s.get('window')) for s in config}
+            removed = [i for i, (definition, _) in self._sensors.items() if definitions.get(i) != definition]
+            if removed:
+                self._store.unregister(removed)
+
+            sensors = {}
+            dependents = {}
+            for s in config:
+                previous = self._sensors.get(s['id'])
+                if previous is not None and previous[0] == definitions[s['id']]:
+                    sensors[s['id']] = previous
+                else:
+                    sensors[s['id']] = (definitions[s['id']], DERIVED_TYPES[s['type']](s))
+                    self._store.register(s['id'])
+
+                for sensor_id in s['sensors']:
+                    dependents.setdefault(sensor_id, []).append(s['id'])
+
+            self._sensors = sensors
+            self._dependents = dependents
+            self._inputs = {k: v for k, v in self._inputs.items() if k in dependents}
+
+    def __sensors_updated(self, values, _, timestamp):
+        """Store listener, called from the acquisition threads after each update"""
+        now = time.monotonic()
+        with self._lock:
+            changed = set()
+            for sensor_id, value in values.items():
+                dependents = self._dependents.get(sensor_id)
+                if dependents:
+                    self._inputs[sensor_id] = (value, timestamp, now + self._store.remaining(sensor_id))
+                    changed.update(dependents)
+
+            # Values are grouped by their remaining validity
+            updates = {}
+            for derived_id in changed:
+                (_, sensor_ids, _), derived = self._sensors[derived_id]
+                inputs = [self._inputs.get(i) for i in sensor_ids]
+                if any(i is None or i[2] <= now for i in inputs):
+                    continue
+
+                value = derived.update([i[0] for i in inputs], max(i[1] for i in inputs))
+                if value is not None:
+                    expires = min(i[2] for i in inputs)
+                    updates.setdefault(expires, {})[derived_id] = round(value, 2)
+
+        # Derived sensors can't be used by other derived sensors, so this doesn't recurse further
+        for expires, derived_values in updates.items():
+            self._store.update(derived_values, None if expires == float('inf') else expires - now)
@@ -14,93 +14,305 @@
 # You should have received a copy of the GNU General Public License
 # along with rockit.  If not, see <http://www.gnu.org/licenses/>.
 
-import datetime
-from collections import deque
-import re
-from statistics import median
 import sys
-import threading
 import time
 import traceback
 import serial
+from .filters import create_filter
+from .hotplug import DeviceHotplugWatcher
+from .protocol import AsciiFrameParser, BinaryFrameParser, COMMAND_ASCII, COMMAND_BINARY, COMMAND_RATE
 
-SENSOR_REGEX = [
-    r'(?P<channel>[0123]):TH;(?P<temperature>\d+\.\d+);(?P<humidity>\d+\.\d+)\r\n',
-    r'(?P<channel>[0123]):T;(?P<temperature>\d+\.\d+)\r\n',
-]
+# Reconnection attempts back off exponentially between these delays (in seconds).
+# The device is also reopened as soon as its node reappears, so the retries are a fallback
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 10
+
+
+class DigitalBoardReader:
+    """Reads the sensors attached to a single Arduino board through its own serial port"""
+    def __init__(self, board, store, scheduler, metrics):
+        self._board = board
+        self._store = store
+        self._scheduler = scheduler
+        self._metrics = metrics
+        self._parser = self.__create_parser(board)
+        self._sensor_timeout = None
+
+        # (channel, reading type) -> (filter definition, filter)
+        self._definitions = {}
+        self._filters = [{} for _ in range(board['channels'])]
+        self._sensor_ids = [{} for _ in range(board['channels'])]
+
+        self._port = None
+        self._port_error = False
+        self._hotplug = None
+        self._retry_task = None
+        self._retry_delay = RECONNECT_MIN_DELAY
+        self._closed = False
+
+        scheduler.call_soon(self.__connect, self.__task_name('digital_connect'))
+
+    def __task_name(self, name):
+        return name + ':' + self._board['id']
+
+    def __create_parser(self, board):
+        if board['serial_protocol'] == 'binary':
+            return BinaryFrameParser(self._metrics, board['channels'], board=board['id'])
+        return AsciiFrameParser(self._metrics, board['channels'], board=board['id'])
+
+    def configure_sensors(self, sensors, median_samples, sensor_timeout):
+        """
+        Builds the filters for each channel from a list of sensor definitions,
+        reusing any whose definition has not changed
+        """
+        definitions = {}
+        filters = [{} for _ in range(self._board['channels'])]
+        sensor_ids = [{} for _ in range(self._board['channels'])]
+        for sensor in sensors:
+            channel = sensor['channel']
+            reading_type = sensor['type']
+
+            # The global median window only applies to sensors without their own filters
+            definition = (sensor.get('filters'), None if 'filters' in sensor else median_samples)
+            previous = self._definitions.get((channel, reading_type))
+            if previous is not None and previous[0] == definition:
+                sensor_filter = previous[1]
+            else:
+                sensor_filter = create_filter(sensor.get('filters'), median_samples)
+
+            definitions[(channel, reading_type)] = (definition, sensor_filter)
+            filters[channel][reading_type] = sensor_filter
+            sensor_ids[channel].setdefault(reading_type, []).append(sensor['id'])
+
+        self._definitions = definitions
+        self._filters = filters
+        self._sensor_ids = sensor_ids
+        self._sensor_timeout = sensor_timeout
+
+    @property
+    def channels(self):
+        return self._board['channels']
+
+    def get_filter(self, channel, reading_type):
+        return self._definitions[(channel, reading_type)][1]
+
+    def reconfigure(self, board):
+        """
+        Applies new port settings, reopening the port if they have changed.
+        The channel count must not change. Must be called from the scheduler thread.
+        """
+        previous = self._board
+        self._board = board
+        if board == previous:
+            return
+
+        self.__close_port()
+        self._parser = self.__create_parser(board)
+        self._port_error = False
+        self._retry_delay = RECONNECT_MIN_DELAY
+        self.__connect()
+
+    def __close_port(self):
+        if self._port is not None:
+            self._scheduler.remove_reader(self._port.fileno())
+            self._port.close()
+            self._port = None
+
+        if self._retry_task is not None:
+            self._scheduler.cancel(self._retry_task)
+            self._retry_task = None
+
+        if self._hotplug is not None:
+            self._hotplug.close()
+            self._hotplug = None
+
+    def close(self):
+        """Closes the port, e.g. when the board is removed from the config. Must be called from the scheduler thread"""
+        self._closed = True
+        self.__close_port()
+
+    def __watch_hotplug(self):
+        """Starts watching for the port's device node to reappear. Must be called from the scheduler thread"""
+        if self._hotplug is not None:
+            return
+
+        try:
+            self._hotplug = DeviceHotplugWatcher(self._board['serial_port'], self._scheduler,
+                                                 self.__device_appeared, self.__task_name('hotplug'))
+        except Exception:
+            print('Unable to watch for {} to reappear'.format(self._board['serial_port']))
+            traceback.print_exc(file=sys.stdout)
+
+    def __device_appeared(self):
+        if self._port is not None:
+            return
+
+        self._metrics.increment('domealert_serial_hotplug_events_total', board=self._board['id'])
+        if self._retry_task is not None:
+            self._scheduler.cancel(self._retry_task)
+            self._retry_task = None
+
+        self.__connect()
+
+    def __schedule_retry(self):
+        if self._retry_task is not None:
+            self._scheduler.cancel(self._retry_task)
+
+        self._retry_task = self._scheduler.call_later(self._retry_delay, self.__retry,
+                                                      self.__task_name('digital_connect'))
+        self._retry_delay = min(2 * self._retry_delay, RECONNECT_MAX_DELAY)
+
+    def __retry(self):
+        self._retry_task = None
+        self.__connect()
+
+    def __connect(self):
+        if self._port is not None or self._closed:
+            return
+
+        self.__watch_hotplug()
+        try:
+            # The port is read without blocking whenever the scheduler reports that data is available
+            self._port = serial.Serial(self._board['serial_port'], self._board['serial_baud'],
+                                       timeout=0, write_timeout=self._board['serial_timeout'])
+            print('Connected to', self._board['serial_port'])
+            self._metrics.increment('domealert_serial_connects_total', board=self._board['id'])
+
+            # Select the output format and measurement rate.
+            # The firmware keeps these settings until it is reset, so they are always sent
+            protocol = COMMAND_BINARY if self._board['serial_protocol'] == 'binary' else COMMAND_ASCII
+            self._port.write(protocol + COMMAND_RATE + bytes([self._board['serial_rate']]))
+
+            self._parser.reset()
+            self._port_error = False
+            self._retry_delay = RECONNECT_MIN_DELAY
+            self._scheduler.add_reader(self.__task_name('digital_serial'), self._port.fileno(), self.__read_port)
+        except Exception as exception:
+            if not self._port_error:
+                print(exception)
+                print('Will retry when the device reappears')
+
+            self._port_error = True
+            if self._port is not None:
+                self._port.close()
+                self._port = None
+            self.__schedule_retry()
+
+    def __disconnect(self):
+        self._metrics.increment('domealert_serial_errors_total', board=self._board['id'])
+        self._scheduler.remove_reader(self._port.fileno())
+        self._port.close()
+        self._port = None
+        if not self._port_error:
+            traceback.print_exc(file=sys.stdout)
+            print('Will retry when the device reappears')
+
+        self._port_error = True
+        self.__schedule_retry()
+
+    def __read_port(self):
+        start = time.monotonic()
+        try:
+            data = self._port.read(max(1, self._port.in_waiting))
+        except Exception:
+            self.__disconnect()
+            return
+
+        self._metrics.increment('domealert_serial_bytes_total', len(data), board=self._board['id'])
+
+        values = {}
+        raw = {}
+        for frame in self._parser.feed(data):
+            for channel, readings in enumerate(frame):
+                if not readings:
+                    continue
+
+                for reading_type, raw_value in readings.items():
+                    channel_filter = self._filters[channel].get(reading_type)
+                    if channel_filter is None:
+                        continue
+
+                    value = round(channel_filter.update(raw_value), 2)
+                    for sensor_id in self._sensor_ids[channel][reading_type]:
+                        values[sensor_id] = value
+                        raw[sensor_id] = raw_value
+
+        # Publish all the frames from this read as a single update
+        if values:
+            self._store.update(values, self._sensor_timeout, raw)
+
+        self._metrics.observe('domealert_serial_read_seconds', time.monotonic() - start, board=self._board['id'])
 
 
 class DigitalSensorsWatcher:
-    def __init__(self, config):
-        self._config = config
-        self._sensor_regex = [re.compile(r) for r in SENSOR_REGEX]
-        self._data = [{} for _ in range(4)]
-        self._updated = [{} for _ in range(4)]
+    """
+    Manages a DigitalBoardReader for each board. Each board has its own port and
+    channel numbering, and is read independently of the others as data arrives.
+    """
+    def __init__(self, config, store, scheduler, metrics):
+        self._store = store
+        self._scheduler = scheduler
+        self._metrics = metrics
+
+        # board id -> DigitalBoardReader
+        self._boards = {}
+
+        # sensor id -> (board id, channel, reading type, filter definition)
+        self._sensors = {}
+        self.reconfigure(config)
+
+    def reconfigure(self, config):
+        """
+        Applies a new configuration. Unchanged sensors keep their filter state, and ports
+        are only reopened if their settings have changed. Must be called from the scheduler
+        thread once it has started, except for the initial configuration.
+        """
+        boards = {}
+        for board in config.digital_boards:
+            reader = self._boards.pop(board['id'], None)
+            if reader is not None and reader.channels != board['channels']:
+                reader.close()
+                reader = None
+
+            if reader is None:
+                reader = DigitalBoardReader(board, self._store, self._scheduler, self._metrics)
+            else:
+                reader.reconfigure(board)
+            boards[board['id']] = reader
+
+        for reader in self._boards.values():
+            reader.close()
+        self._boards = boards
+
+        board_sensors = {board_id: [] for board_id in boards}
+        sensors = {}
         for sensor in config.digital_sensors:
-            queue = deque(maxlen=config.sensor_median_samples)
-            self._data[sensor['channel']][sensor['type']] = queue
-            self._updated[sensor['channel']][sensor['type']] = datetime.datetime.min
-
-        if self._config.digital_serial_port:
-            threading.Thread(target=self.run, daemon=True).start()
-
-    def run(self):
-        """Main run loop"""
-        port_error = False
-        while True:
-            # Initial setup
-            try:
-                port = serial.Serial(self._config.digital_serial_port, self._config.digital_serial_baud,
-                                     timeout=self._config.digital_serial_timeout)
-                print('Connected to', self._config.digital_serial_port)
-
-                port_error = False
-            except Exception as exception:
-                if not port_error:
-                    print(exception)
-                    print('Will retry in 10 seconds...')
-
-                port_error = True
-                time.sleep(10.)
-                continue
-
-            try:
-                # First line may have been only partially received
-                port.readline()
-
-                # Main run loop
-                while True:
-                    data = port.readline().decode('ascii')
-                    for r in self._sensor_regex:
-                        match = r.match(data)
-                        if match:
-                            fields = match.groupdict()
-                            channel = int(fields['channel'])
-                            for f in fields:
-                                if f == 'channel' or f not in self._data[channel]:
-                                    continue
-
-                                self._data[channel][f].append(float(fields[f]))
-                                self._updated[channel][f] = datetime.datetime.now(datetime.timezone.utc)
-
-            except Exception:
-                port.close()
-                if not port_error:
-                    traceback.print_exc(file=sys.stdout)
-
-                    print('Will retry in 10 seconds...')
-                port_error = True
-                time.sleep(10.)
-
-    def export_measurements(self, data):
-        for sensor in self._config.digital_sensors:
-            try:
-                value = median(self._data[sensor['channel']][sensor['type']])
-                updated = self._updated[sensor['channel']][sensor['type']]
-                valid = (datetime.datetime.now(datetime.timezone.utc) - updated).total_seconds() < self._config.sensor_timeout
-            except:
-                value = 0
-                valid = False
-
-            data[sensor['id']] = round(value, 2)
-            data[sensor['id'] + '_valid'] = valid
+            board_id = sensor.get('board', config.digital_boards[0]['id'])
+            board_sensors[board_id].append(sensor)
+            sensors[sensor['id']] = (board_id, sensor['channel'], sensor['type'], sensor.get('filters'),
+                                     None if 'filters' in sensor else config.sensor_median_samples)
+
+        for board_id, reader in boards.items():
+            reader.configure_sensors(board_sensors[board_id], config.sensor_median_samples, config.sensor_timeout)
+
+        # Fields are (re)registered here rather than by each board so that sensors can move between boards
+        removed = [i for i, s in self._sensors.items() if sensors.get(i) != s]
+        if removed:
+            self._store.unregister(removed)
+
+        for sensor_id, sensor in sensors.items():
+            if self._sensors.get(sensor_id) != sensor:
+                self._store.register(sensor_id)
+
+        self._sensors = sensors
+
+    def get_filter_state(self):
+        """Returns a dictionary of sensor id to filter state. Must be called from the scheduler thread"""
+        return {i: self._boards[b].get_filter(c, t).get_state() for i, (b, c, t, _, _) in self._sensors.items()}
+
+    def set_filter_state(self, state):
+        """Restores filter state returned by get_filter_state(). Must be called from the scheduler thread"""
+        for sensor_id, sensor_state in state.items():
+            if sensor_id in self._sensors:
+                board_id, channel, reading_type, _, _ = self._sensors[sensor_id]
+                self._boards[board_id].get_filter(channel, reading_type).set_state(sensor_state)
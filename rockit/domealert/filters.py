@@ -0,0 +1,296 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming filters that are applied to each sensor reading as it arrives"""
+
+from bisect import bisect_left, insort
+from collections import deque
+from heapq import heapify, heappop, heappush
+
+# Scale factor that converts a median absolute deviation to a standard deviation for gaussian noise
+MAD_SIGMA_SCALE = 1.4826
+
+
+class RollingMedian:
+    """
+    Median over a sliding window of the most recent samples.
+    Maintains the lower and upper halves of the window in a pair of heaps so that
+    each update costs O(log n) instead of re-sorting the whole window.
+    """
+    def __init__(self, window):
+        self._size = max(1, int(window))
+        self.reset()
+
+    def reset(self):
+        self._window = deque()
+        self._sequence = 0
+
+        # Entries are (value, sequence) pairs so that every sample is unique.
+        # _low is a max-heap stored as (-value, -sequence); _high is a min-heap.
+        # Samples that leave the window are deleted lazily when they reach the top of a heap.
+        self._low = []
+        self._high = []
+        self._low_count = 0
+        self._high_count = 0
+        self._removed = set()
+
+    def update(self, value):
+        """Adds a sample and returns the median of the current window"""
+        if len(self._window) == self._size:
+            self.__remove(self._window.popleft())
+
+        self._sequence += 1
+        item = (value, self._sequence)
+        self._window.append(item)
+
+        if self._low and item <= self.__low_top():
+            heappush(self._low, (-value, -self._sequence))
+            self._low_count += 1
+        else:
+            heappush(self._high, item)
+            self._high_count += 1
+
+        self.__rebalance()
+        return self.value()
+
+    def value(self):
+        """Returns the median of the current window, or None if it is empty"""
+        if not self._window:
+            return None
+
+        if self._low_count > self._high_count:
+            return -self._low[0][0]
+        return (self._high[0][0] - self._low[0][0]) / 2
+
+    def get_state(self):
+        """Returns the window contents as a json-serializable object"""
+        return {'type': 'median', 'window': [value for value, _ in self._window]}
+
+    def set_state(self, state):
+        """Restores the window from get_state(), keeping the most recent samples if the window has shrunk"""
+        if state.get('type') != 'median':
+            return
+
+        self.reset()
+        for value in state['window'][-self._size:]:
+            self.update(value)
+
+    def __low_top(self):
+        value, sequence = self._low[0]
+        return -value, -sequence
+
+    def __remove(self, item):
+        self._removed.add(item[1])
+        if self._low and item <= self.__low_top():
+            self._low_count -= 1
+        else:
+            self._high_count -= 1
+
+        # Rebuild the heaps if expired samples have accumulated below their tops
+        if len(self._low) + len(self._high) > 2 * self._size:
+            items = sorted(self._window)
+            split = (len(items) + 1) // 2
+            self._low = [(-v, -s) for v, s in items[:split]]
+            self._high = items[split:]
+            heapify(self._low)
+            self._low_count = len(self._low)
+            self._high_count = len(self._high)
+            self._removed.clear()
+
+    def __prune(self):
+        while self._low and -self._low[0][1] in self._removed:
+            self._removed.discard(-heappop(self._low)[1])
+        while self._high and self._high[0][1] in self._removed:
+            self._removed.discard(heappop(self._high)[1])
+
+    def __rebalance(self):
+        self.__prune()
+        while self._low_count > self._high_count + 1:
+            value, sequence = heappop(self._low)
+            heappush(self._high, (-value, -sequence))
+            self._low_count -= 1
+            self._high_count += 1
+            self.__prune()
+
+        while self._low_count < self._high_count:
+            value, sequence = heappop(self._high)
+            heappush(self._low, (-value, -sequence))
+            self._high_count -= 1
+            self._low_count += 1
+            self.__prune()
+
+
+class ExponentialMovingAverage:
+    """Exponentially weighted moving average with smoothing factor alpha"""
+    def __init__(self, alpha):
+        self._alpha = alpha
+        self._value = None
+
+    def update(self, value):
+        if self._value is None:
+            self._value = value
+        else:
+            self._value += self._alpha * (value - self._value)
+        return self._value
+
+    def value(self):
+        return self._value
+
+    def reset(self):
+        self._value = None
+
+    def get_state(self):
+        return {'type': 'ema', 'value': self._value}
+
+    def set_state(self, state):
+        if state.get('type') == 'ema':
+            self._value = state['value']
+
+
+def _kth_deviation(values, split, center, k):
+    """
+    Returns the k'th smallest (from 0) absolute deviation from center of the sorted list values,
+    where split is the index of the first value >= center. The deviations below and above the
+    center form two sorted sequences, so this is a selection from two sorted arrays in O(log n).
+    """
+    def below(i):
+        return center - values[split - 1 - i]
+
+    def above(i):
+        return values[split + i] - center
+
+    below_count = split
+    above_count = len(values) - split
+
+    # Binary search for the number of deviations taken from below the center
+    low = max(0, k + 1 - above_count)
+    high = min(k + 1, below_count)
+    while low < high:
+        taken = (low + high) // 2
+        if below(taken) < above(k - taken):
+            low = taken + 1
+        else:
+            high = taken
+
+    candidates = []
+    if low > 0:
+        candidates.append(below(low - 1))
+    if k + 1 - low > 0:
+        candidates.append(above(k - low))
+    return max(candidates)
+
+
+class HampelFilter:
+    """
+    Replaces samples that deviate from the median of the recent window by more than
+    threshold standard deviations (estimated using the median absolute deviation).
+    The center comes from a RollingMedian, and the median absolute deviation is selected
+    from a sorted copy of the window, so that each update avoids re-sorting the window.
+    """
+    def __init__(self, window, threshold):
+        self._size = max(1, int(window))
+        self._window = deque()
+        self._sorted = []
+        self._median = RollingMedian(self._size)
+        self._threshold = threshold
+        self._value = None
+
+    def update(self, value):
+        if len(self._window) == self._size:
+            del self._sorted[bisect_left(self._sorted, self._window.popleft())]
+        self._window.append(value)
+        insort(self._sorted, value)
+        center = self._median.update(value)
+
+        count = len(self._sorted)
+        split = bisect_left(self._sorted, center)
+        mad = _kth_deviation(self._sorted, split, center, count // 2)
+        if count % 2 == 0:
+            mad = (mad + _kth_deviation(self._sorted, split, center, count // 2 - 1)) / 2
+
+        if abs(value - center) > self._threshold * MAD_SIGMA_SCALE * mad:
+            self._value = center
+        else:
+            self._value = value
+        return self._value
+
+    def value(self):
+        return self._value
+
+    def reset(self):
+        self._window.clear()
+        self._sorted.clear()
+        self._median.reset()
+        self._value = None
+
+    def get_state(self):
+        return {'type': 'hampel', 'window': list(self._window), 'value': self._value}
+
+    def set_state(self, state):
+        if state.get('type') == 'hampel':
+            self.reset()
+            for value in state['window'][-self._size:]:
+                self.update(value)
+            self._value = state['value']
+
+
+class FilterPipeline:
+    """Applies a sequence of filters to each sample"""
+    def __init__(self, stages):
+        self._stages = stages
+
+    def update(self, value):
+        for stage in self._stages:
+            value = stage.update(value)
+        return value
+
+    def value(self):
+        return self._stages[-1].value()
+
+    def reset(self):
+        for stage in self._stages:
+            stage.reset()
+
+    def get_state(self):
+        return [stage.get_state() for stage in self._stages]
+
+    def set_state(self, state):
+        """Restores the state of each stage. Ignored if the pipeline has changed since the state was saved"""
+        if len(state) != len(self._stages):
+            return
+
+        for stage, stage_state in zip(self._stages, state):
+            stage.set_state(stage_state)
+
+
+def create_filter(filter_config, median_samples):
+    """
+    Builds the filter pipeline for a sensor from the optional 'filters' list in its config.
+    Sensors without a filter list use a rolling median over median_samples samples.
+    """
+    if not filter_config:
+        return FilterPipeline([RollingMedian(median_samples)])
+
+    stages = []
+    for stage in filter_config:
+        if stage['type'] == 'median':
+            stages.append(RollingMedian(stage.get('window', median_samples)))
+        elif stage['type'] == 'ema':
+            stages.append(ExponentialMovingAverage(stage.get('alpha', 0.5)))
+        elif stage['type'] == 'hampel':
+            stages.append(HampelFilter(stage.get('window', median_samples), stage.get('threshold', 3)))
+
+    return FilterPipeline(stages)
@@ -0,0 +1,150 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory time series of recent sensor values"""
+
+from array import array
+import math
+import threading
+import time
+
+
+class SensorHistory:
+    """
+    Fixed-capacity ring buffer of timestamped samples stored in flat arrays.
+    Samples are stored against the monotonic clock so that they stay in order if the system clock
+    is stepped (e.g. by NTP on a Raspberry Pi without a RTC), and converted to unix time when queried.
+    """
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('f', bytes(4 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def append(self, timestamp, value):
+        index = (self._start + self._count) % self._capacity
+        self._times[index] = timestamp
+        self._values[index] = value
+        if self._count < self._capacity:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % self._capacity
+
+    @property
+    def last_time(self):
+        if self._count == 0:
+            return None
+        return self._times[(self._start + self._count - 1) % self._capacity]
+
+    def __bisect(self, timestamp):
+        """Returns the logical index of the first sample at or after timestamp"""
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._times[(self._start + mid) % self._capacity] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def __slice(self, data, first, last):
+        """Returns a copy of the logical indices first to last of data"""
+        begin = self._start + first
+        stop = self._start + last
+        if stop <= self._capacity:
+            return data[begin:stop]
+        if begin >= self._capacity:
+            return data[begin - self._capacity:stop - self._capacity]
+        return data[begin:] + data[:stop - self._capacity]
+
+    def copy(self, start, end):
+        """Returns copies of the (times, values) arrays for the samples between the monotonic times start and end"""
+        first = self.__bisect(start)
+        last = self.__bisect(end)
+        return self.__slice(self._times, first, last), self.__slice(self._values, first, last)
+
+
+def format_samples(times, values, start, offset, step=None):
+    """
+    Returns a list of [timestamp, value] samples from the arrays returned by SensorHistory.copy(),
+    where start is the unix time of the first bin and offset is the difference between the
+    unix and monotonic clocks. If step is given, samples are averaged into step-second bins
+    and each bin is reported at its start time.
+    """
+    if step is None:
+        return [[round(t + offset, 3), round(v, 2)] for t, v in zip(times, values)]
+
+    samples = []
+    bin_start = None
+    bin_total = 0
+    bin_count = 0
+    for sample_time, value in zip(times, values):
+        sample_bin = start + math.floor((sample_time + offset - start) / step) * step
+        if sample_bin != bin_start:
+            if bin_count:
+                samples.append([bin_start, round(bin_total / bin_count, 2)])
+            bin_start = sample_bin
+            bin_total = 0
+            bin_count = 0
+
+        bin_total += value
+        bin_count += 1
+
+    if bin_count:
+        samples.append([bin_start, round(bin_total / bin_count, 2)])
+
+    return samples
+
+
+class MeasurementHistory:
+    """Records the values published to a MeasurementStore at a limited rate"""
+    def __init__(self, duration, interval):
+        self._capacity = int(math.ceil(duration / interval)) + 1
+
+        # Allow some jitter in the sample times without dropping samples
+        self._min_spacing = 0.9 * interval
+        self._lock = threading.Lock()
+        self._sensors = {}
+
+    def record(self, values, _, __):
+        """Store listener that appends each new value to the history of its field"""
+        timestamp = time.monotonic()
+        with self._lock:
+            for sensor_id, value in values.items():
+                history = self._sensors.get(sensor_id)
+                if history is None:
+                    history = self._sensors[sensor_id] = SensorHistory(self._capacity)
+                else:
+                    last_time = history.last_time
+                    if last_time is not None and timestamp - last_time < self._min_spacing:
+                        continue
+
+                history.append(timestamp, float(value))
+
+    def query(self, sensor_ids, start, end, step=None):
+        """Returns a dictionary of sensor id to a list of [timestamp, value] samples"""
+        offset = time.time() - time.monotonic()
+
+        # The samples are copied with the lock held, but formatted without it so that
+        # a long query doesn't block record() (and with it the acquisition threads)
+        with self._lock:
+            if sensor_ids is None:
+                sensor_ids = list(self._sensors)
+
+            copies = {s: self._sensors[s].copy(start - offset, end - offset) for s in sensor_ids if s in self._sensors}
+
+        return {s: format_samples(times, values, start, offset, step) for s, (times, values) in copies.items()}
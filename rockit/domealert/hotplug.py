@@ -0,0 +1,140 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Notifies when a device node (or a udev symlink to one) is created, using inotify"""
+
+import ctypes
+import os
+import struct
+import sys
+import traceback
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# udev creates the node and then sets its permissions, so also watch for attribute changes
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+
+# watch descriptor, mask, cookie, name length
+EVENT_STRUCT = struct.Struct('iIII')
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (AttributeError, OSError):
+    _inotify_init1 = None
+
+
+class DeviceHotplugWatcher:
+    """
+    Calls callback from the scheduler thread when path may have appeared.
+
+    The directory containing path is watched, or the nearest existing parent
+    if it does not exist yet (e.g. /dev/serial/by-id is removed along with
+    the last USB serial device). Spurious callbacks are possible, so the
+    callback should simply try to open the device.
+    """
+    def __init__(self, path, scheduler, callback, name='hotplug'):
+        self._path = os.path.abspath(path)
+        self._scheduler = scheduler
+        self._callback = callback
+        self._watch = None
+        self._watch_path = None
+        self._fd = None
+
+        if _inotify_init1 is None:
+            raise OSError('inotify is not available')
+
+        fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._fd = fd
+        self.__update_watch()
+        scheduler.add_reader(name, fd, self.__read_events)
+
+    def __update_watch(self):
+        """Watches the closest existing ancestor directory of path"""
+        watch_path = os.path.dirname(self._path)
+        while not os.path.isdir(watch_path):
+            watch_path = os.path.dirname(watch_path)
+
+        if watch_path == self._watch_path:
+            return
+
+        # Adding a watch to a new directory leaves the old one in place,
+        # but that only causes occasional spurious callbacks
+        watch = _inotify_add_watch(self._fd, os.fsencode(watch_path), WATCH_MASK)
+        if watch < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for ' + watch_path)
+
+        self._watch = watch
+        self._watch_path = watch_path
+
+    def __read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+
+        # Only the next path component towards the device is interesting
+        relative = os.path.relpath(self._path, self._watch_path)
+        target = relative.split(os.sep)[0]
+
+        triggered = False
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = EVENT_STRUCT.unpack_from(data, offset)
+            offset += EVENT_STRUCT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if watch != self._watch:
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # The watched directory has gone: watch its parent instead
+                self._watch_path = None
+                triggered = True
+            elif os.fsdecode(name) == target:
+                triggered = True
+
+        if not triggered:
+            return
+
+        try:
+            self.__update_watch()
+        except Exception:
+            print('Exception while updating hotplug watch for ' + self._path)
+            traceback.print_exc(file=sys.stdout)
+
+        if os.path.exists(self._path):
+            self._callback()
+
+    def close(self):
+        """Stops watching. Must be called from the scheduler thread"""
+        if self._fd is not None:
+            self._scheduler.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
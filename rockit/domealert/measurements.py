@@ -0,0 +1,263 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import threading
+import time
+
+
+class MeasurementStore:
+    """
+    Collects the latest value from every watcher and publishes an immutable
+    snapshot dictionary each time a sample arrives.
+
+    Readers receive the most recent snapshot without taking any locks.
+    Validity is tracked using monotonic deadlines, so the snapshot only needs
+    to be rebuilt when a sample arrives or a field's deadline passes.
+    The date is refreshed by copying the snapshot at most once per second.
+
+    Each snapshot is assigned an increasing sequence number, and each field
+    records the sequence number of the last snapshot in which it was sampled
+    or changed validity. wait() uses these to block until a field is updated.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._values = {}
+        self._updated = {}
+        self._expires = {}
+        self._sequence = 0
+        self._field_sequence = {}
+        self._listeners = []
+
+        # (snapshot, monotonic time when the snapshot or its date must be rebuilt)
+        # Replaced as a single tuple so that readers always see a consistent pair
+        self._published = ({}, 0)
+
+        # Monotonic time when the next valid field times out
+        self._next_expiry = 0
+
+    def register(self, sensor_id, value=0):
+        """Adds a field that will be reported as invalid until its first sample arrives"""
+        with self._lock:
+            self._values[sensor_id] = value
+            self._updated[sensor_id] = None
+            self._expires[sensor_id] = 0
+            self.__publish(time.monotonic(), [sensor_id])
+
+    def unregister(self, sensor_ids):
+        """Removes fields that are no longer measured"""
+        with self._lock:
+            for sensor_id in sensor_ids:
+                self._values.pop(sensor_id, None)
+                self._updated.pop(sensor_id, None)
+                self._expires.pop(sensor_id, None)
+            self.__publish(time.monotonic(), sensor_ids)
+
+    def add_listener(self, callback):
+        """
+        Registers a function that is called as callback(values, raw, timestamp) after each update,
+        where timestamp is the unix time of the samples. Listeners are called from the
+        acquisition threads, so must return quickly.
+        """
+        self._listeners.append(callback)
+
+    def update(self, values, timeout, raw=None):
+        """
+        Records new samples for one or more fields and publishes a new snapshot.
+        values is a dictionary of field id to (filtered) value.
+        timeout is the number of seconds the values remain valid, or None if they never expire.
+        raw is an optional dictionary of field id to the unfiltered value, passed on to listeners.
+        """
+        with self._lock:
+            # Taken with the lock held so that updates are timestamped in the order they are applied
+            now = time.monotonic()
+            timestamp = time.time()
+            expires = float('inf') if timeout is None else now + timeout
+            for sensor_id, value in values.items():
+                self._values[sensor_id] = value
+                self._updated[sensor_id] = now
+                self._expires[sensor_id] = expires
+            self.__publish(now, values)
+
+        if raw is None:
+            raw = values
+
+        for listener in self._listeners:
+            listener(values, raw, timestamp)
+
+    def invalidate(self, sensor_ids):
+        """Marks fields as invalid without waiting for them to time out"""
+        with self._lock:
+            for sensor_id in sensor_ids:
+                self._expires[sensor_id] = 0
+            self.__publish(time.monotonic(), sensor_ids)
+
+    def export_state(self):
+        """
+        Returns a dictionary of field id to [value, unix time of the last sample, timeout]
+        for fields that have been sampled, where timeout is the number of seconds the value
+        was valid for after its sample (None if it never expires)
+        """
+        now = time.monotonic()
+        timestamp = time.time()
+        with self._lock:
+            state = {}
+            for sensor_id, updated in self._updated.items():
+                if updated is not None:
+                    expires = self._expires[sensor_id]
+                    timeout = None if expires == float('inf') else max(0, expires - updated)
+                    state[sensor_id] = [self._values[sensor_id], timestamp - (now - updated), timeout]
+            return state
+
+    def restore(self, state, timeout):
+        """
+        Restores values returned by export_state() in a previous run for fields that have been registered
+        but not yet sampled. Each value remains valid for the same time after its original sample as it
+        was when saved, or timeout seconds for state saved without one. Listeners are not called.
+        """
+        now = time.monotonic()
+        timestamp = time.time()
+        with self._lock:
+            restored = []
+            for sensor_id, (value, sampled, *saved_timeout) in state.items():
+                age = timestamp - sampled
+                if sensor_id not in self._updated or self._updated[sensor_id] is not None or age < 0:
+                    continue
+
+                field_timeout = saved_timeout[0] if saved_timeout else timeout
+                self._values[sensor_id] = value
+                self._updated[sensor_id] = now - age
+                self._expires[sensor_id] = float('inf') if field_timeout is None else now - age + field_timeout
+                restored.append(sensor_id)
+            self.__publish(now, restored)
+
+    def __publish(self, now, changed):
+        """Builds a new snapshot. Must be called with self._lock held"""
+        previous, _ = self._published
+        self._sequence += 1
+        timestamp = time.time()
+        snapshot = {
+            'date': format_date(timestamp)
+        }
+
+        rebuild = float('inf')
+        for sensor_id, value in self._values.items():
+            expires = self._expires[sensor_id]
+            valid = now < expires
+            snapshot[sensor_id] = value
+            snapshot[sensor_id + '_valid'] = valid
+            if valid:
+                rebuild = min(rebuild, expires)
+
+            if previous.get(sensor_id + '_valid') != valid:
+                self._field_sequence[sensor_id] = self._sequence
+
+        for sensor_id in changed:
+            self._field_sequence[sensor_id] = self._sequence
+
+        self._next_expiry = rebuild
+        self._published = (snapshot, min(rebuild, now + 1 - timestamp % 1))
+        self._condition.notify_all()
+
+    def __refresh(self, now):
+        """
+        Rebuilds the snapshot if a field has timed out, otherwise updates its date
+        without changing the sequence number. Must be called with self._lock held
+        """
+        if now >= self._next_expiry:
+            self.__publish(now, [])
+            return
+
+        timestamp = time.time()
+        snapshot = dict(self._published[0])
+        snapshot['date'] = format_date(timestamp)
+        self._published = (snapshot, min(self._next_expiry, now + 1 - timestamp % 1))
+
+    def snapshot(self):
+        """Returns the latest snapshot. The returned dictionary must not be modified"""
+        snapshot, rebuild = self._published
+        now = time.monotonic()
+        if now < rebuild:
+            return snapshot
+
+        # A field has timed out or the date has changed since the snapshot was built
+        with self._lock:
+            snapshot, rebuild = self._published
+            if now >= rebuild:
+                self.__refresh(now)
+                snapshot, _ = self._published
+            return snapshot
+
+    def __last_sequence(self, fields):
+        """Returns the sequence number of the last update to any of fields. Must be called with self._lock held"""
+        if fields is None:
+            return self._sequence
+        return max((self._field_sequence.get(f, 0) for f in fields), default=0)
+
+    def wait(self, since, timeout, fields=None):
+        """
+        Blocks until one of fields (or any field if None) is updated in a snapshot
+        newer than sequence number since, or until timeout seconds have elapsed.
+        Returns a tuple of the latest sequence number and snapshot.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+
+                # Publish fields that have timed out so that waiters are notified
+                if now >= self._published[1]:
+                    self.__refresh(now)
+                snapshot, _ = self._published
+
+                if self.__last_sequence(fields) > since or now >= deadline:
+                    return self._sequence, filter_snapshot(snapshot, fields)
+
+                self._condition.wait(min(deadline, self._next_expiry) - now)
+
+    def last_sequence(self, fields=None):
+        """Returns the sequence number of the last snapshot that updated any of fields"""
+        with self._lock:
+            return self.__last_sequence(fields)
+
+    def remaining(self, sensor_id):
+        """Returns the number of seconds until a field times out (inf if it never does), or 0 if it is invalid"""
+        with self._lock:
+            return max(0, self._expires.get(sensor_id, 0) - time.monotonic())
+
+    def ages(self):
+        """Returns the number of seconds since the last sample for each field, or None if there are none"""
+        now = time.monotonic()
+        with self._lock:
+            return {k: None if v is None else round(now - v, 3) for k, v in self._updated.items()}
+
+
+def format_date(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def filter_snapshot(snapshot, fields):
+    """Returns a copy of snapshot containing only the date and the given fields"""
+    if fields is None:
+        return snapshot
+
+    filtered = {'date': snapshot['date']}
+    for f in fields:
+        if f in snapshot:
+            filtered[f] = snapshot[f]
+            filtered[f + '_valid'] = snapshot[f + '_valid']
+    return filtered
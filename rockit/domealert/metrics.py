@@ -0,0 +1,181 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and latency histograms for the acquisition sources and Pyro methods"""
+
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def add(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in items) + '}'
+
+
+class Metrics:
+    """Thread-safe registry of labelled counters and histograms"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+        # source -> (counters, histograms) most recently reported by another process
+        self._remote = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def dump(self):
+        """Returns a picklable copy of the counters and histograms, for merge() in another process"""
+        with self._lock:
+            histograms = {}
+            for key, histogram in self._histograms.items():
+                histograms[key] = Histogram()
+                histograms[key].add(histogram)
+            return dict(self._counters), histograms
+
+    def merge(self, source, dump):
+        """Includes the values returned by dump() in another process, replacing any previous ones from source"""
+        with self._lock:
+            self._remote[source] = dump
+
+    def retire(self, source):
+        """Folds the last values merged from source into the local ones, so they persist after it restarts"""
+        with self._lock:
+            counters, histograms = self._remote.pop(source, ({}, {}))
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+            for key, histogram in histograms.items():
+                self._histograms.setdefault(key, Histogram()).add(histogram)
+
+    def __combined(self):
+        """Returns the local and remote counters and histograms. Must be called with self._lock held"""
+        counters = dict(self._counters)
+        histograms = dict(self._histograms)
+        for remote_counters, remote_histograms in self._remote.values():
+            for key, value in remote_counters.items():
+                counters[key] = counters.get(key, 0) + value
+
+            for key, histogram in remote_histograms.items():
+                if key in histograms:
+                    combined = Histogram()
+                    combined.add(histograms[key])
+                    combined.add(histogram)
+                    histogram = combined
+                histograms[key] = histogram
+        return counters, histograms
+
+    def export(self):
+        """Returns a dictionary of metric name to a list of labelled values, for the Pyro stats() call"""
+        data = {}
+        with self._lock:
+            counters, histograms = self.__combined()
+            for (name, labels), value in sorted(counters.items()):
+                data.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+            for (name, labels), histogram in sorted(histograms.items(), key=lambda i: i[0]):
+                data.setdefault(name, []).append({
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'mean': round(histogram.sum / histogram.count, 6) if histogram.count else 0,
+                    'max': round(histogram.max, 6)
+                })
+        return data
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters, histograms = self.__combined()
+            last_name = None
+            for (name, labels), value in sorted(counters.items()):
+                if name != last_name:
+                    lines.append('# TYPE {} counter'.format(name))
+                    last_name = name
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+            for (name, labels), histogram in sorted(histograms.items(), key=lambda i: i[0]):
+                if name != last_name:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    last_name = name
+
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, ('le', bound)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serves Metrics.render() over HTTP from a background thread"""
+    def __init__(self, metrics, ip, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self._server = ThreadingHTTPServer((ip, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
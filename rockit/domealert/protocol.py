@@ -0,0 +1,258 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parsers for the measurement output of the Arduino firmware"""
+
+import binascii
+import struct
+
+# Number of channels reported in each measurement cycle by arduino/main.c
+CHANNEL_COUNT = 4
+
+# Commands understood by the firmware
+COMMAND_ASCII = b'A'
+COMMAND_BINARY = b'B'
+COMMAND_RATE = b'R'
+
+# Binary frame layout: sync word, sequence number, channel count,
+# channel records, then a CRC-16/CCITT of everything after the sync word
+FRAME_SYNC = b'\xa5\x5a'
+FRAME_HEADER_STRUCT = struct.Struct('<2sHB')
+
+# one-wire status, device family code, temperature and humidity in hundredths
+FRAME_CHANNEL_STRUCT = struct.Struct('<BBhh')
+FRAME_CRC_STRUCT = struct.Struct('<H')
+
+# Largest channel count accepted in a frame header, which bounds the wait for the rest of a corrupted frame
+MAX_FRAME_CHANNELS = 16
+
+ONEWIRE_STATUS_OK = 0
+ONEWIRE_STATUS_NONE = 1
+ONEWIRE_STATUS_NAMES = ['ok', 'none', 'unknown', 'error']
+
+# Family code of the DS2438, which also reports humidity
+DS2438_FAMILY = 0x26
+
+
+class AsciiFrameParser:
+    """
+    Splits the firmware's text output into frames, where each frame holds one measurement
+    cycle: a line of the form "<channel>:<reading>\\r\\n" for each channel in order.
+
+    The reading is "TH;<temperature>;<humidity>" for a DS2438, "T;<temperature>"
+    for a DS18B20/DS1820, "NONE" if no sensor is attached, and "UNKNOWN;<type>"
+    or empty if the sensor could not be identified or read.
+
+    The firmware may report fewer channels than channel_count, so the length of its cycle
+    is learned from where the channel numbers wrap, and frames are finished at its end.
+    """
+    def __init__(self, metrics, channel_count=CHANNEL_COUNT, **labels):
+        # labels are added to every metric, e.g. to identify the board
+        self._metrics = metrics
+        self._labels = labels
+        self._channel_count = channel_count
+        self._buffer = b''
+        self._synchronised = False
+        self._frame = None
+        self._last_channel = -1
+        self._cycle_length = 0
+
+    def reset(self):
+        """Discards any buffered data, e.g. after the port is reopened"""
+        self._buffer = b''
+        self._synchronised = False
+        self._frame = None
+        self._last_channel = -1
+        self._cycle_length = 0
+
+    def feed(self, data):
+        """
+        Parses bytes read from the port, returning a list of frames that were completed.
+        Each frame is a list with an entry for each channel: None if the channel
+        was not reported, otherwise a dictionary of reading type to value.
+        """
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        frames = []
+        for line in lines:
+            # The first line may have been only partially received
+            if not self._synchronised:
+                self._synchronised = True
+                continue
+
+            self.__parse_line(line, frames)
+
+        return frames
+
+    def __parse_line(self, line, frames):
+        channel, separator, reading = line.rstrip(b'\r').partition(b':')
+        try:
+            if not separator:
+                raise ValueError('missing channel separator')
+
+            channel = int(channel)
+            if not 0 <= channel < self._channel_count:
+                raise ValueError('invalid channel')
+
+            if reading.startswith(b'TH;'):
+                temperature, humidity = reading[3:].split(b';')
+                values = {'temperature': float(temperature), 'humidity': float(humidity)}
+            elif reading.startswith(b'T;'):
+                values = {'temperature': float(reading[2:])}
+            elif reading in (b'', b'NONE') or reading.startswith(b'UNKNOWN;'):
+                values = {}
+            else:
+                raise ValueError('unknown reading')
+        except ValueError:
+            self._metrics.increment('domealert_serial_malformed_lines_total', **self._labels)
+            return
+
+        # A channel that doesn't follow the previous one means that the previous cycle has ended,
+        # either because the firmware reports fewer channels or the remaining lines were lost:
+        # publish what was received
+        if channel <= self._last_channel:
+            self._cycle_length = max(self._cycle_length, self._last_channel + 1)
+            self.__finish_frame(frames)
+
+        if self._frame is None:
+            self._frame = [None] * self._channel_count
+
+        self._frame[channel] = values
+        self._last_channel = channel
+        if channel in (self._channel_count - 1, self._cycle_length - 1):
+            self.__finish_frame(frames)
+
+    def __finish_frame(self, frames):
+        if self._frame is None:
+            return
+
+        # Only the channels that the firmware reports can be missing
+        self._metrics.increment('domealert_serial_frames_total', **self._labels)
+        if any(r is None for r in self._frame[:self._cycle_length or self._channel_count]):
+            self._metrics.increment('domealert_serial_partial_frames_total', **self._labels)
+
+        frames.append(self._frame)
+        self._frame = None
+        self._last_channel = -1
+
+
+class BinaryFrameParser:
+    """
+    Decodes the firmware's binary frames, resynchronising on the sync word after corrupted data.
+    Frames that are lost in transit are detected (and counted) using the sequence number.
+
+    Each frame reports its own channel count, which may differ from channel_count:
+    channels that the frame doesn't report are None, and extra channels are ignored.
+    """
+    def __init__(self, metrics, channel_count=CHANNEL_COUNT, **labels):
+        # labels are added to every metric, e.g. to identify the board
+        self._metrics = metrics
+        self._labels = labels
+        self._channel_count = channel_count
+
+        # Structs for decoding all the channel records of a frame, by channel count
+        self._channel_structs = {}
+        self._buffer = bytearray()
+        self._last_sequence = None
+
+    def reset(self):
+        """Discards any buffered data, e.g. after the port is reopened"""
+        self._buffer.clear()
+        self._last_sequence = None
+
+    def feed(self, data):
+        """
+        Parses bytes read from the port, returning a list of frames that were completed.
+        Each frame is a list with an entry for each channel: None if the channel was not
+        reported, otherwise a dictionary of reading type to value, which is empty if the
+        channel had no valid reading.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        offset = 0
+        while True:
+            start = buffer.find(FRAME_SYNC, offset)
+            if start < 0:
+                # Keep a trailing byte that may be the start of the next sync word
+                if len(buffer) - 1 > offset:
+                    self._metrics.increment('domealert_serial_discarded_bytes_total', len(buffer) - 1 - offset,
+                                            **self._labels)
+                    offset = len(buffer) - 1
+                break
+
+            if start > offset:
+                self._metrics.increment('domealert_serial_discarded_bytes_total', start - offset, **self._labels)
+
+            if len(buffer) - start < FRAME_HEADER_STRUCT.size:
+                offset = start
+                break
+
+            _, sequence, channel_count = FRAME_HEADER_STRUCT.unpack_from(buffer, start)
+            if not 0 < channel_count <= MAX_FRAME_CHANNELS:
+                self._metrics.increment('domealert_serial_malformed_frames_total', **self._labels)
+                offset = start + 1
+                continue
+
+            end = start + FRAME_HEADER_STRUCT.size + channel_count * FRAME_CHANNEL_STRUCT.size \
+                + FRAME_CRC_STRUCT.size
+            if len(buffer) < end:
+                offset = start
+                break
+
+            crc, = FRAME_CRC_STRUCT.unpack_from(buffer, end - FRAME_CRC_STRUCT.size)
+            if binascii.crc_hqx(buffer[start + 2:end - FRAME_CRC_STRUCT.size], 0xFFFF) != crc:
+                # Not a real frame: search for the next sync word
+                self._metrics.increment('domealert_serial_malformed_frames_total', **self._labels)
+                offset = start + 1
+                continue
+
+            if self._last_sequence is not None:
+                dropped = (sequence - self._last_sequence - 1) & 0xFFFF
+                if dropped:
+                    self._metrics.increment('domealert_serial_dropped_frames_total', dropped, **self._labels)
+            self._last_sequence = sequence
+
+            frames.append(self.__decode(buffer, start + FRAME_HEADER_STRUCT.size, channel_count))
+            offset = end
+
+        del buffer[:offset]
+        self._metrics.increment('domealert_serial_frames_total', len(frames), **self._labels)
+        return frames
+
+    def __decode(self, buffer, offset, channel_count):
+        channel_struct = self._channel_structs.get(channel_count)
+        if channel_struct is None:
+            channel_struct = self._channel_structs[channel_count] = struct.Struct('<' + 'BBhh' * channel_count)
+
+        fields = channel_struct.unpack_from(buffer, offset)
+        frame = []
+        for channel in range(min(channel_count, self._channel_count)):
+            status, family, temperature, humidity = fields[4 * channel:4 * channel + 4]
+            if status != ONEWIRE_STATUS_OK:
+                # A channel without a sensor attached is not an error
+                if status != ONEWIRE_STATUS_NONE:
+                    name = ONEWIRE_STATUS_NAMES[status] if status < len(ONEWIRE_STATUS_NAMES) else str(status)
+                    self._metrics.increment('domealert_onewire_errors_total', channel=channel, status=name,
+                                            **self._labels)
+                frame.append({})
+            elif family == DS2438_FAMILY:
+                frame.append({'temperature': temperature / 100., 'humidity': humidity / 100.})
+            else:
+                frame.append({'temperature': temperature / 100.})
+
+        frame.extend([None] * (self._channel_count - len(frame)))
+        return frame
@@ -14,126 +14,515 @@
 # You should have received a copy of the GNU General Public License
 # along with rockit.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import deque
-import datetime
+import functools
 from glob import glob
 import os.path
-from statistics import median
 import sys
 import threading
 import time
 import traceback
+from .filters import create_filter
 
+W1_DEVICES_PATH = '/sys/bus/w1/devices'
 
-def read_value(f_file, retries=5):
+# Maximum time to wait for a 12 bit DS18B20 conversion (750ms) to complete
+W1_BULK_CONVERSION_TIMEOUT = 1.5
+W1_BULK_CHECK_INTERVAL = 0.05
+
+
+def read_value(f_file, retries=5, on_retry=None):
     attempt = 0
     while True:
         try:
+            # Sysfs attributes are regenerated when read from the start,
+            # so cached file handles can be reused by seeking back to zero
+            f_file.seek(0)
             return f_file.read()
         except OSError:
             if attempt == retries:
                 raise
+            attempt += 1
+            if on_retry is not None:
+                on_retry()
             time.sleep(0.1)
 
 
 class SensorWatcher:
-    def __init__(self, config, poll_rate, median_samples, age_timeout):
+    """A logical sensor that filters one quantity measured by a DeviceReader"""
+    def __init__(self, config, store, median_samples):
         self._id = config['id']
+        self._type = config['type']
+
+        # Reject outliers by taking a median filter over median_samples samples
+        # or the filter pipeline defined in the sensor config
+        self._filter = create_filter(config.get('filters'), median_samples)
+        store.register(self._id)
+
+        self._fixed_rate = True
+        self._poll_rate = None
+        self._adaptive = None
+        self._interval = None
+        self._last_raw = None
+        self._last_filtered = None
+
+    def set_polling(self, config, default_rate):
+        """
+        Applies the poll_rate and adaptive settings from the sensor config, with default_rate used
+        as the fastest poll interval for sensors without their own. Polling restarts at the fastest interval.
+        """
+        self._fixed_rate = 'poll_rate' not in config and 'adaptive' not in config
+        self._poll_rate = config.get('poll_rate', default_rate)
+        self._adaptive = config.get('adaptive')
+        self._interval = self._poll_rate
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def fixed_rate(self):
+        """True if the sensor uses the default poll interval"""
+        return self._fixed_rate
+
+    @property
+    def interval(self):
+        """The number of seconds until the sensor should next be polled"""
+        return self._interval
+
+    def update(self, value):
+        """Adds a raw sample and returns the filtered value"""
+        filtered = round(self._filter.update(value), 2)
+        if self._adaptive is not None:
+            self.__adapt(value, filtered)
+        return filtered
+
+    def __adapt(self, raw, filtered):
+        """
+        Doubles the poll interval after each stable sample, or returns to the fastest interval on activity.
+        The raw sample is checked as well as the filtered value, because a median filter hides a step
+        change until it fills half of the window, which takes a long time at the slowest interval.
+        """
+        change = self._adaptive['change']
+        active = self._last_raw is not None and (abs(raw - self._last_raw) >= change
+                                                 or abs(filtered - self._last_filtered) >= change)
+
+        limit = self._adaptive.get('limit')
+        margin = self._adaptive.get('limit_margin', 0)
+        if limit is not None and (abs(raw - limit) <= margin or abs(filtered - limit) <= margin):
+            active = True
+
+        self._last_raw = raw
+        self._last_filtered = filtered
+        if active:
+            self._interval = self._poll_rate
+        else:
+            self._interval = min(self._interval * 2, max(self._poll_rate, self._adaptive['max_poll_rate']))
+
+    def get_state(self):
+        return self._filter.get_state()
+
+    def set_state(self, state):
+        self._filter.set_state(state)
+
+
+class DeviceReader:
+    """
+    Reads every quantity needed by the logical sensors on a physical 1-wire device
+    in a single pass and distributes the results to each SensorWatcher.
+
+    read() blocks on the 1-wire bus, so is called from one of the scheduler's blocking threads,
+    and its results are passed to publish() on the scheduler thread.
+    """
+    def __init__(self, device, sensors, store, metrics, age_timeout, poll_rate, devices_path=W1_DEVICES_PATH,
+                 bulk_read=False):
+        self._device = device
+        self._sensors = sensors
+        self._store = store
+        self._metrics = metrics
         self._age_timeout = age_timeout
-        self._updated = datetime.datetime.min
         self._poll_rate = poll_rate
-        self._lock = threading.Lock()
-        self._type = config['type']
-        self._device_path = os.path.join('/sys/bus/w1/devices', config['device'])
+        self._device_path = os.path.join(devices_path, device)
+        self._bulk_read = bulk_read
+        self._is_ds18b20 = any(s.type == 't' for s in sensors)
+        self._read_humidity = any(s.type == 'thh' for s in sensors)
         self._available = False
+        self._closed = False
+
+        # Protects _closed and _reading, so that close() never waits for a read to finish
+        self._lock = threading.Lock()
+        self._reading = False
 
-        # Reject outliers by taking a median filter over buffer_size samples
-        self._buffer = deque(maxlen=median_samples)
-        self._value = 0
+        # Open sysfs attribute handles, resolved on first use and reused until a read fails
+        self._files = None
 
-        loop = threading.Thread(target=self.__poll_sensor)
-        loop.daemon = True
-        loop.start()
+    @property
+    def device(self):
+        return self._device
 
-    def __poll_sensor(self):
-        while True:
-            available = False
-            updated = False
-            try:
-                if not os.path.exists(self._device_path):
-                    continue
-
-                if self._type == 't':
-                    # hwmon index is not fixed
-                    paths = glob(os.path.join(self._device_path, 'hwmon/hwmon*/temp*_input'))
-                    if not paths:
-                        continue
-
-                    with open(paths[0], 'r') as f_file:
-                        value = int(read_value(f_file)) / 1000.
-                        available = updated = True
-
-                else:
-                    temperature_path = os.path.join(self._device_path, 'temperature')
-
-                    with open(temperature_path, 'r') as f_file:
-                        temperature_raw = int(read_value(f_file))
-                        temperature = (temperature_raw >> 3) * 0.03125
-
-                    if self._type == 'thh':
-                        vad_path = os.path.join(self._device_path, 'vad')
-                        vdd_path = os.path.join(self._device_path, 'vdd')
-                        if not os.path.exists(vad_path) or not os.path.exists(vdd_path):
-                            continue
-
-                        with open(vad_path, 'r') as f_file:
-                            vad = float(read_value(f_file))
-
-                        with open(vdd_path, 'r') as f_file:
-                            vdd = float(read_value(f_file))
-
-                        sensor_rh = (vad / vdd - 0.16) / 0.0062
-                        value = sensor_rh / (1.0546 - 0.00216 * temperature)
-
-                        # A race condition between temperature, vad, vdd can produce a calculated humidity > 100%
-                        # Skip these bad readings
-                        available = True
-                        updated = value <= 100
-                    else:
-                        value = temperature
-                        available = updated = True
-
-                if updated:
-                    with self._lock:
-                        self._buffer.append(value)
-                        self._value = median(self._buffer)
-                        self._updated = datetime.datetime.now(datetime.timezone.utc)
+    @property
+    def sensors(self):
+        return self._sensors
 
-            except Exception:
-                if self._available:
-                    print('Exception while polling {}'.format(self._id))
-                    traceback.print_exc(file=sys.stdout)
+    @property
+    def bulk_read(self):
+        return self._bulk_read
+
+    @property
+    def age_timeout(self):
+        return self._age_timeout
+
+    @age_timeout.setter
+    def age_timeout(self, value):
+        self._age_timeout = value
+
+    @property
+    def poll_rate(self):
+        """The default poll interval, which age_timeout applies to"""
+        return self._poll_rate
+
+    @poll_rate.setter
+    def poll_rate(self, value):
+        self._poll_rate = value
+
+    @property
+    def interval(self):
+        """The number of seconds until the device should next be polled"""
+        return min(s.interval for s in self._sensors)
+
+    def close(self):
+        """Stops publishing values, e.g. when the device is removed from the config"""
+        with self._lock:
+            self._closed = True
+            if self._reading:
+                # read() closes the files once it has finished with them
+                return
+        self.__close_files()
+
+    def __open_files(self):
+        """Returns a dictionary of open attribute files, or None if the device or an attribute is missing"""
+        if not os.path.exists(self._device_path):
+            return None
+
+        paths = {}
+        if self._is_ds18b20 and not self._bulk_read:
+            # hwmon index is not fixed
+            hwmon_paths = glob(os.path.join(self._device_path, 'hwmon/hwmon*/temp*_input'))
+            if not hwmon_paths:
+                return None
+            paths['temperature'] = hwmon_paths[0]
+        else:
+            # The temperature attribute returns the result of the last bulk conversion
+            # whereas the hwmon interface always starts a new conversion
+            paths['temperature'] = os.path.join(self._device_path, 'temperature')
+
+        if self._read_humidity:
+            paths['vad'] = os.path.join(self._device_path, 'vad')
+            paths['vdd'] = os.path.join(self._device_path, 'vdd')
+
+        if not all(os.path.exists(p) for p in paths.values()):
+            return None
+
+        files = {}
+        try:
+            for key, path in paths.items():
+                files[key] = open(path, 'rb', buffering=0)  # pylint: disable=consider-using-with
+        except Exception:
+            for f_file in files.values():
+                f_file.close()
+            raise
+
+        return files
+
+    def __close_files(self):
+        if self._files is not None:
+            for f_file in self._files.values():
+                try:
+                    f_file.close()
+                except OSError:
+                    pass
+            self._files = None
+
+    def __read(self, key):
+        return read_value(self._files[key], on_retry=self.__count_retry)
+
+    def __count_retry(self):
+        self._metrics.increment('domealert_w1_read_retries_total', device=self._device)
+
+    def __read_ds18b20(self):
+        return {'t': int(self.__read('temperature')) / 1000.}
+
+    def __read_ds2438(self):
+        temperature_raw = int(self.__read('temperature'))
+        temperature = (temperature_raw >> 3) * 0.03125
 
-            finally:
-                if available != self._available:
-                    if available:
-                        print('Sensor ' + self._id + ' connected')
-                    else:
-                        print('Sensor ' + self._id + ' disconnected')
+        values = {'tht': temperature}
+        if self._read_humidity:
+            # Reading the voltages straight after the temperature from the same thread
+            # ensures that all three values come from the same measurement cycle
+            vad = float(self.__read('vad'))
+            vdd = float(self.__read('vdd'))
 
-                self._available = available
-                time.sleep(self._poll_rate)
+            sensor_rh = (vad / vdd - 0.16) / 0.0062
+            values['thh'] = sensor_rh / (1.0546 - 0.00216 * temperature)
+            if values['thh'] > 100:
+                self._metrics.increment('domealert_humidity_out_of_range_total', device=self._device)
 
-    def export_measurement(self, data):
+        return values
+
+    def read(self):
+        """Reads the device, returning a dictionary of sensor type to value, or None if it is unavailable"""
         with self._lock:
-            data[self._id] = round(self._value, 2)
-            data[self._id + '_valid'] = (datetime.datetime.now(datetime.timezone.utc) - self._updated).total_seconds() < self._age_timeout
+            if self._closed:
+                return None
+            self._reading = True
+
+        try:
+            return self.__read_values()
+        finally:
+            with self._lock:
+                self._reading = False
+                closed = self._closed
+            if closed:
+                self.__close_files()
+
+    def __read_values(self):
+        start = time.monotonic()
+        try:
+            if self._files is None:
+                self._files = self.__open_files()
+                if self._files is None:
+                    return None
+
+            if self._is_ds18b20:
+                values = self.__read_ds18b20()
+            else:
+                values = self.__read_ds2438()
+
+            self._metrics.observe('domealert_w1_read_seconds', time.monotonic() - start, device=self._device)
+            return values
+
+        except Exception:
+            # The device may have been removed or replaced: resolve the paths again next time
+            self.__close_files()
+            self._metrics.increment('domealert_w1_read_errors_total', device=self._device)
+            if self._available:
+                print('Exception while polling {}'.format(self._device))
+                traceback.print_exc(file=sys.stdout)
+            return None
+
+    def publish(self, values):
+        """Publishes the values returned by read() to each of the sensors. Must be called from the scheduler thread"""
+        if self._closed:
+            return
+
+        available = values is not None
+        if available != self._available:
+            ids = ', '.join(s.id for s in self._sensors)
+            if available:
+                print('Sensor ' + ids + ' connected')
+            else:
+                print('Sensor ' + ids + ' disconnected')
+        self._available = available
+
+        if available:
+            raw = {s.id: values[s.type] for s in self._sensors}
+            filtered = {s.id: s.update(values[s.type]) for s in self._sensors}
+
+            # Scale the timeout with the poll interval so that sensors that are polled
+            # less often don't become invalid between samples
+            timeout = self._age_timeout * max(1, self.interval / self._poll_rate)
+            self._store.update(filtered, timeout, raw)
+
+
+class W1BulkReader:
+    """
+    Polls DS18B20-type sensors by triggering a simultaneous temperature conversion
+    on every w1 bus master and then reading back the results from each device.
+    Runs on the scheduler's blocking threads, and calls poll_device(device) to read each device.
+    """
+    def __init__(self, devices, scheduler, poll_device, devices_path=W1_DEVICES_PATH):
+        self._devices = devices
+        self._scheduler = scheduler
+        self._poll_device = poll_device
+        self._devices_path = devices_path
+        self._bus_error = False
+        self._pending = []
+        self._deadline = 0
+
+    def trigger(self):
+        """Starts a conversion on every bus and schedules the collection of the results"""
+        # __collect is only scheduled from here, and this returns until it has
+        # finished with _pending, so the two never modify it at the same time
+        if self._pending:
+            # The previous conversion is still being collected
+            return
+
+        try:
+            for bus_path in glob(os.path.join(self._devices_path, 'w1_bus_master*')):
+                devices = [d for d in self._devices if os.path.exists(os.path.join(bus_path, d.device))]
+                if devices:
+                    with open(os.path.join(bus_path, 'therm_bulk_read'), 'w') as f_file:
+                        f_file.write('trigger\n')
+                    self._pending.append((bus_path, devices))
+
+            # Update the status of any devices that have disappeared from the bus
+            for device in self._devices:
+                if not any(device in devices for _, devices in self._pending):
+                    self._poll_device(device)
+
+            self._bus_error = False
+        except Exception:
+            if not self._bus_error:
+                print('Exception while triggering bulk conversion')
+                traceback.print_exc(file=sys.stdout)
+            self._bus_error = True
+
+        if self._pending:
+            self._deadline = time.monotonic() + W1_BULK_CONVERSION_TIMEOUT
+            self._scheduler.call_later(W1_BULK_CHECK_INTERVAL, self.__collect, 'w1_bulk_collect', blocking=True)
+
+    def __collect(self):
+        """Reads the devices on each bus that has finished converting"""
+        timed_out = time.monotonic() > self._deadline
+        pending = []
+        for bus_path, devices in self._pending:
+            try:
+                # therm_bulk_read reads as -1 while any device on the bus is still converting
+                with open(os.path.join(bus_path, 'therm_bulk_read'), 'r') as f_file:
+                    converting = read_value(f_file).strip() == '-1'
+            except Exception:
+                converting = False
+
+            if converting and not timed_out:
+                pending.append((bus_path, devices))
+            else:
+                for device in devices:
+                    self._poll_device(device)
+
+        self._pending = pending
+        if pending:
+            self._scheduler.call_later(W1_BULK_CHECK_INTERVAL, self.__collect, 'w1_bulk_collect', blocking=True)
 
 
 class RJ11SensorsWatcher:
-    def __init__(self, sensor_config, poll_rate, median_samples, age_timeout):
-        self._sensors = [SensorWatcher(s, poll_rate, median_samples, age_timeout) for s in sensor_config]
+    def __init__(self, sensor_config, store, scheduler, metrics, poll_rate, median_samples, age_timeout,
+                 bulk_read=False, devices_path=W1_DEVICES_PATH):
+        self._store = store
+        self._scheduler = scheduler
+        self._metrics = metrics
+        self._devices_path = devices_path
+
+        # sensor id -> (measurement definition, SensorWatcher)
+        self._sensors = {}
+
+        # device -> (DeviceReader, periodic task or None if read in bulk)
+        self._devices = {}
+        self._bulk_task = None
+        self.reconfigure(sensor_config, poll_rate, median_samples, age_timeout, bulk_read)
+
+    def reconfigure(self, sensor_config, poll_rate, median_samples, age_timeout, bulk_read):  # pylint: disable=too-many-branches
+        """
+        Applies a new set of sensor definitions. Sensors and devices that are unchanged keep
+        their filter state and open files. Must be called from the scheduler thread once it has started.
+        """
+        definitions = {}
+        for s in sensor_config:
+            # Labels and units don't affect the measurement, and the global
+            # median window only applies to sensors without their own filters
+            definitions[s['id']] = (s['type'], s['device'], s.get('filters'),
+                                    None if 'filters' in s else median_samples)
+
+        removed = [i for i, (definition, _) in self._sensors.items() if definitions.get(i) != definition]
+        if removed:
+            self._store.unregister(removed)
+
+        sensors = {}
+        for s in sensor_config:
+            previous = self._sensors.get(s['id'])
+            if previous is not None and previous[0] == definitions[s['id']]:
+                sensors[s['id']] = previous
+            else:
+                sensors[s['id']] = (definitions[s['id']], SensorWatcher(s, self._store, median_samples))
+            sensors[s['id']][1].set_polling(s, poll_rate)
+        self._sensors = sensors
+
+        # Group the logical sensors by physical device so that each device is only read once per cycle
+        device_sensors = {}
+        for s in sensor_config:
+            device_sensors.setdefault(s['device'], []).append(sensors[s['id']][1])
+
+        devices = {}
+        for device, watchers in device_sensors.items():
+            # DS2438-based sensors are not supported by the w1_therm bulk read,
+            # and the bulk read only runs at the default poll interval
+            bulk = bulk_read and all(s.type == 't' and s.fixed_rate for s in watchers)
+            reader, task = self._devices.pop(device, (None, None))
+            if reader is not None and (reader.sensors != watchers or reader.bulk_read != bulk):
+                self.__stop_device(reader, task)
+                reader = task = None
+
+            if reader is None:
+                reader = DeviceReader(device, watchers, self._store, self._metrics, age_timeout, poll_rate,
+                                      devices_path=self._devices_path, bulk_read=bulk)
+            else:
+                reader.age_timeout = age_timeout
+                reader.poll_rate = poll_rate
+
+            if task is not None and task.interval != reader.interval:
+                self._scheduler.cancel(task)
+                task = None
+
+            if task is None and not bulk:
+                task = self._scheduler.add_periodic('rj11:' + device, reader.interval,
+                                                    functools.partial(self.__poll_device, reader), blocking=True)
+
+            devices[device] = (reader, task)
+
+        for reader, task in self._devices.values():
+            self.__stop_device(reader, task)
+        self._devices = devices
+
+        if self._bulk_task is not None:
+            self._scheduler.cancel(self._bulk_task)
+            self._bulk_task = None
+
+        bulk_devices = [reader for reader, task in devices.values() if reader.bulk_read]
+        if bulk_devices:
+            bulk_reader = W1BulkReader(bulk_devices, self._scheduler, self.__poll_device,
+                                       devices_path=self._devices_path)
+            self._bulk_task = self._scheduler.add_periodic('w1_bulk_trigger', poll_rate, bulk_reader.trigger,
+                                                           blocking=True)
+
+    def __poll_device(self, reader):
+        """Reads a device from the blocking thread and hands the values to the scheduler thread"""
+        values = reader.read()
+        self._scheduler.call_soon(functools.partial(self.__publish_device, reader, values))
+
+    def __publish_device(self, reader, values):
+        reader.publish(values)
+
+        # Adaptive sensors may have changed the time until the next poll
+        current, task = self._devices.get(reader.device, (None, None))
+        if current is reader and task is not None:
+            interval = reader.interval
+            if interval != task.interval:
+                self._scheduler.set_interval(task, interval)
+
+    def get_filter_state(self):
+        """Returns a dictionary of sensor id to filter state. Must be called from the scheduler thread"""
+        return {sensor_id: watcher.get_state() for sensor_id, (_, watcher) in self._sensors.items()}
+
+    def set_filter_state(self, state):
+        """Restores filter state returned by get_filter_state(). Must be called from the scheduler thread"""
+        for sensor_id, sensor_state in state.items():
+            if sensor_id in self._sensors:
+                self._sensors[sensor_id][1].set_state(sensor_state)
 
-    def export_measurements(self, data):
-        for s in self._sensors:
-            s.export_measurement(data)
+    def __stop_device(self, reader, task):
+        if task is not None:
+            self._scheduler.cancel(task)
+        reader.close()
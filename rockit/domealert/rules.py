@@ -0,0 +1,251 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Threshold rules that are evaluated as samples arrive and can drive the relay output"""
+
+import datetime
+import sys
+import threading
+import time
+import traceback
+
+# Interval in seconds between checks for rules whose sensor has stopped reporting valid values
+RULE_CHECK_INTERVAL = 1
+
+# Sensors that haven't reported a valid value this long after a rule is created are treated as invalid
+RULE_STARTUP_GRACE = 10
+
+
+class Rule:
+    """
+    Tracks whether a sensor has met a condition for at least hold seconds.
+
+    An 'above' rule triggers when the value exceeds threshold and clears once it falls
+    to threshold - hysteresis ('below' rules are the reverse). An 'equals' rule triggers
+    when the value equals value and clears as soon as it differs.
+
+    While the sensor has no valid value the rule is treated as met ('trigger', the default,
+    so that a failed sensor can't hide an alarm), not met ('clear'), or keeps its state ('hold').
+    """
+    def __init__(self, config):
+        self._condition = config['condition']
+        self._threshold = config.get('threshold')
+        self._hysteresis = config.get('hysteresis', 0)
+        self._value = config.get('value')
+        self._hold = config.get('hold', 0)
+        self._invalid = config.get('invalid', 'trigger')
+        self._created = time.time()
+        self._pending_since = None
+        self.valid = False
+        self.triggered = False
+        self.triggers = 0
+        self.last_value = None
+        self.last_triggered = None
+        self.last_cleared = None
+
+    def __met(self, value):
+        if self._condition == 'equals':
+            return value == self._value
+
+        # Once triggered the value must pass back beyond the hysteresis band to clear
+        margin = self._hysteresis if self.triggered else 0
+        if self._condition == 'above':
+            return value > self._threshold - margin
+        return value < self._threshold + margin
+
+    @property
+    def deadline(self):
+        """The unix time when the rule will trigger if its condition remains met, or None"""
+        if self.triggered or self._pending_since is None:
+            return None
+        return self._pending_since + self._hold
+
+    def update(self, value, timestamp):
+        """Evaluates a new sample. Returns True if the triggered state changed"""
+        self.last_value = value
+        self.valid = True
+        return self.__evaluate(self.__met(value), timestamp)
+
+    def invalidate(self, timestamp):
+        """Evaluates the rule while its sensor has no valid value. Returns True if the triggered state changed"""
+        # Give new sensors a chance to report their first sample
+        if not self.valid and timestamp - self._created < RULE_STARTUP_GRACE:
+            return False
+
+        self.valid = False
+        if self._invalid == 'hold':
+            return False
+        return self.__evaluate(self._invalid == 'trigger', timestamp)
+
+    def check(self, timestamp):
+        """Triggers the rule if its condition has been met for hold seconds. Returns True if it triggered"""
+        deadline = self.deadline
+        if deadline is None or timestamp < deadline:
+            return False
+        return self.__evaluate(True, timestamp)
+
+    def __evaluate(self, met, timestamp):
+        if not met:
+            self._pending_since = None
+            if self.triggered:
+                self.triggered = False
+                self.last_cleared = timestamp
+                return True
+            return False
+
+        if self.triggered:
+            return False
+
+        if self._pending_since is None:
+            self._pending_since = timestamp
+
+        if timestamp - self._pending_since < self._hold:
+            return False
+
+        self.triggered = True
+        self.triggers += 1
+        self.last_triggered = timestamp
+        return True
+
+
+def format_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class RuleEngine:
+    """
+    Evaluates rules as a MeasurementStore listener whenever their sensor is updated.
+    Rules are also re-checked on the scheduler when their hold time expires, because
+    switches in edge detection mode and slow sensors may not report again for some time,
+    and periodically to detect sensors that have stopped reporting valid values.
+
+    The relay is switched on when the first relay rule triggers, and off again
+    when the last one clears, so that it can still be set manually in between.
+    """
+    def __init__(self, config, store, scheduler, metrics, set_relay):
+        self._store = store
+        self._scheduler = scheduler
+        self._metrics = metrics
+        self._set_relay = set_relay
+        self._lock = threading.Lock()
+
+        # rule id -> (rule definition, Rule)
+        self._rules = {}
+
+        # sensor id -> list of rule ids that use it
+        self._dependents = {}
+
+        self.reconfigure(config)
+        store.add_listener(self.__sensors_updated)
+        scheduler.add_periodic('rules', RULE_CHECK_INTERVAL, self.__check_rules, delay=RULE_CHECK_INTERVAL)
+
+    def reconfigure(self, config):
+        """Applies a new set of rules. Unchanged rules keep their state"""
+        with self._lock:
+            was_active = self.__relay_active()
+            rules = {}
+            dependents = {}
+            for r in config:
+                # Labels don't affect the rule
+                definition = {k: v for k, v in r.items() if k != 'label'}
+                previous = self._rules.get(r['id'])
+                if previous is not None and previous[0] == definition:
+                    rules[r['id']] = previous
+                else:
+                    rules[r['id']] = (definition, Rule(r))
+                dependents.setdefault(r['sensor'], []).append(r['id'])
+
+            self._rules = rules
+            self._dependents = dependents
+            self.__update_relay(was_active)
+
+    def __relay_active(self):
+        """Must be called with self._lock held"""
+        return any(rule.triggered for definition, rule in self._rules.values() if definition.get('relay', False))
+
+    def __update_relay(self, was_active):
+        """Must be called with self._lock held"""
+        active = self.__relay_active()
+        if active == was_active:
+            return
+
+        try:
+            self._set_relay(active)
+            print('info: Rules switched relay ' + ('on' if active else 'off'))
+        except Exception:
+            print('error: Failed to set relay from rules')
+            traceback.print_exc(file=sys.stdout)
+
+    def __changed(self, rule_id, rule):
+        """Must be called with self._lock held"""
+        print('info: Rule {} {}'.format(rule_id, 'triggered' if rule.triggered else 'cleared'))
+        if rule.triggered:
+            self._metrics.increment('domealert_rule_triggers_total', rule=rule_id)
+
+    def __sensors_updated(self, values, _, timestamp):
+        """Store listener, called from the acquisition threads after each update"""
+        with self._lock:
+            was_active = self.__relay_active()
+            for sensor_id, value in values.items():
+                for rule_id in self._dependents.get(sensor_id, []):
+                    rule = self._rules[rule_id][1]
+                    deadline = rule.deadline
+                    if rule.update(value, timestamp):
+                        self.__changed(rule_id, rule)
+
+                    # Check again when the hold expires, in case the sensor doesn't report before then
+                    if rule.deadline is not None and rule.deadline != deadline:
+                        self._scheduler.call_later(rule.deadline - timestamp, self.__check_rules, 'rule_hold')
+
+            self.__update_relay(was_active)
+
+    def __check_rules(self):
+        """Triggers rules whose hold time has expired, and evaluates rules whose sensor is invalid"""
+        snapshot = self._store.snapshot()
+        timestamp = time.time()
+        with self._lock:
+            was_active = self.__relay_active()
+            for rule_id, (definition, rule) in self._rules.items():
+                if not snapshot.get(definition['sensor'] + '_valid', False):
+                    changed = rule.invalidate(timestamp)
+                else:
+                    changed = rule.check(timestamp)
+
+                if changed:
+                    self.__changed(rule_id, rule)
+
+            self.__update_relay(was_active)
+
+    def status(self):
+        """
+        Returns the state, trigger count, latest value and its validity,
+        and times of the last trigger and clear of each rule
+        """
+        with self._lock:
+            return {
+                rule_id: {
+                    'triggered': rule.triggered,
+                    'relay': definition.get('relay', False),
+                    'triggers': rule.triggers,
+                    'value': rule.last_value,
+                    'valid': rule.valid,
+                    'last_triggered': format_timestamp(rule.last_triggered),
+                    'last_cleared': format_timestamp(rule.last_cleared)
+                } for rule_id, (definition, rule) in self._rules.items()
+            }
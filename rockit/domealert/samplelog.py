@@ -0,0 +1,244 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Append-only binary log of every raw and filtered sample.
+
+Each log file starts with a header that lists the field ids, followed by
+fixed-size records of (unix time, field index, raw value, filtered value)
+in time order. A partially written record at the end of a file after a crash is ignored.
+"""
+
+from collections import deque
+import datetime
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import traceback
+
+LOG_MAGIC = b'DALOG'
+LOG_VERSION = 1
+
+# magic, version, header json length
+HEADER_STRUCT = struct.Struct('<5sBI')
+
+# unix time, field index, padding, raw value, filtered value
+RECORD_STRUCT = struct.Struct('<dH2xff')
+
+# Samples are dropped if the writer falls this far behind
+MAX_QUEUE_LENGTH = 100000
+
+
+class SampleLog:
+    """
+    Writes samples received from a MeasurementStore to rotating log files from a background thread.
+    The oldest files are deleted when a new one is started so that at most max_files are kept.
+    """
+    def __init__(self, path, max_size, fields=None, flush_interval=1, fsync_interval=10, max_files=None):
+        self._path = path
+        self._max_size = max_size
+        self._max_files = max_files
+        self._flush_interval = flush_interval
+        self._fsync_interval = fsync_interval
+        self._queue = deque(maxlen=MAX_QUEUE_LENGTH)
+
+        # Fields that are known in advance are listed in the first header
+        # to avoid rotating the file as each one produces its first sample
+        self._fields = {f: i for i, f in enumerate(fields or [])}
+        self._file = None
+        self._file_day = None
+        self._file_size = 0
+        self._file_last_time = None
+        self._last_fsync = 0
+        self._error = False
+        self.dropped = 0
+
+        os.makedirs(path, exist_ok=True)
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def record(self, values, raw, timestamp):
+        """Store listener that queues samples for writing. Never blocks on disk I/O"""
+        if len(self._queue) == MAX_QUEUE_LENGTH:
+            self.dropped += len(values)
+
+        for sensor_id, value in values.items():
+            self._queue.append((timestamp, sensor_id, raw.get(sensor_id, value), value))
+
+    def __open(self, timestamp):
+        self.__close()
+        date = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+        filename = os.path.join(self._path, 'samples-' + date.strftime('%Y%m%dT%H%M%S') + '.dalog')
+
+        # Avoid overwriting a file from the same second after a restart
+        suffix = 1
+        base = filename
+        while os.path.exists(filename):
+            filename = base + '.' + str(suffix)
+            suffix += 1
+
+        header = json.dumps({'fields': list(self._fields)}).encode('utf-8')
+        self._file = open(filename, 'wb')  # pylint: disable=consider-using-with
+        self._file.write(HEADER_STRUCT.pack(LOG_MAGIC, LOG_VERSION, len(header)) + header)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file_day = date.date()
+        self._file_size = HEADER_STRUCT.size + len(header)
+        self._file_last_time = None
+        self._last_fsync = time.monotonic()
+        self.__prune(filename)
+
+    def __prune(self, current):
+        """Deletes the oldest log files so that no more than max_files remain"""
+        if self._max_files is None:
+            return
+
+        filenames = [f for f in sorted(glob.glob(os.path.join(self._path, 'samples-*.dalog*'))) if f != current]
+        for filename in filenames[:max(0, len(filenames) + 1 - self._max_files)]:
+            try:
+                os.remove(filename)
+            except OSError as exception:
+                print(f'error: Failed to delete old sample log {filename}: {exception}')
+
+    def __close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def __write_batch(self):
+        batch = []
+        while self._queue:
+            batch.append(self._queue.popleft())
+
+        if not batch:
+            return
+
+        # Listeners are called outside the store's lock, so samples from different threads may
+        # be queued slightly out of order. Readers bisect on time, so each file must be sorted
+        batch.sort(key=lambda record: record[0])
+
+        # The header lists the known fields, so start a new file if a new field has appeared
+        # or if the clock has gone backwards (e.g. stepped by NTP) since the last batch
+        rotate = self._file is None
+        if self._file_last_time is not None and batch[0][0] < self._file_last_time:
+            rotate = True
+        for _, sensor_id, _, _ in batch:
+            if sensor_id not in self._fields:
+                self._fields[sensor_id] = len(self._fields)
+                rotate = True
+
+        timestamp = batch[0][0]
+        day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+        if rotate or day != self._file_day or self._file_size + len(batch) * RECORD_STRUCT.size > self._max_size:
+            self.__open(timestamp)
+
+        data = bytearray()
+        for timestamp, sensor_id, raw, value in batch:
+            data += RECORD_STRUCT.pack(timestamp, self._fields[sensor_id], float(raw), float(value))
+
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        self._file_last_time = batch[-1][0]
+
+        if time.monotonic() - self._last_fsync > self._fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def __run(self):
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.__write_batch()
+                self._error = False
+            except Exception:
+                if not self._error:
+                    print('Exception while writing sample log')
+                    traceback.print_exc(file=sys.stdout)
+                self._error = True
+
+                try:
+                    self.__close()
+                except Exception:
+                    self._file = None
+
+
+class SampleLogReader:
+    """Memory-maps a log file written by SampleLog so that it can be queried without reading it into memory"""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f_file:
+            self._map = mmap.mmap(f_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_length = HEADER_STRUCT.unpack_from(self._map, 0)
+        if magic != LOG_MAGIC or version != LOG_VERSION:
+            raise ValueError(filename + ' is not a sample log')
+
+        header = json.loads(self._map[HEADER_STRUCT.size:HEADER_STRUCT.size + header_length])
+        self.fields = header['fields']
+        self._offset = HEADER_STRUCT.size + header_length
+
+        # Ignore any partial record left by a crash
+        self._count = (len(self._map) - self._offset) // RECORD_STRUCT.size
+
+    def __len__(self):
+        return self._count
+
+    def __time(self, index):
+        return struct.unpack_from('<d', self._map, self._offset + index * RECORD_STRUCT.size)[0]
+
+    def __bisect(self, timestamp):
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self.__time(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def query(self, fields=None, start=None, end=None):
+        """Yields (unix time, field id, raw value, filtered value) tuples between start and end"""
+        first = 0 if start is None else self.__bisect(start)
+        last = self._count if end is None else self.__bisect(end)
+        indices = None if fields is None else {self.fields.index(f) for f in fields if f in self.fields}
+        for i in range(first, last):
+            timestamp, index, raw, value = RECORD_STRUCT.unpack_from(self._map, self._offset + i * RECORD_STRUCT.size)
+            if indices is None or index in indices:
+                yield timestamp, self.fields[index], raw, value
+
+    def close(self):
+        self._map.close()
+
+
+def query_logs(path, fields=None, start=None, end=None):
+    """Yields (unix time, field id, raw value, filtered value) tuples from all log files in a directory"""
+    for filename in sorted(glob.glob(os.path.join(path, 'samples-*.dalog*'))):
+        try:
+            reader = SampleLogReader(filename)
+        except (ValueError, struct.error):
+            # Skip files whose header was not completely written
+            continue
+
+        try:
+            yield from reader.query(fields, start, end)
+        finally:
+            reader.close()
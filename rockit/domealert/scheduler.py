@@ -0,0 +1,279 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Event loop that drives all sensor I/O, with a separate thread for reads that block"""
+
+import heapq
+import itertools
+import math
+import os
+import queue
+import selectors
+import sys
+import threading
+import time
+import traceback
+
+# Number of threads that run blocking tasks
+BLOCKING_THREADS = 4
+
+
+class ScheduledTask:
+    """A timer registered with AcquisitionScheduler"""
+    def __init__(self, name, callback, deadline, interval=None, blocking=False, stats=None):
+        self.name = name
+        self.callback = callback
+        self.deadline = deadline
+        self.interval = interval
+        self.blocking = blocking
+        self.stats = stats
+        self.cancelled = False
+
+        # True while a blocking callback is queued or running
+        self.running = False
+
+        # True while waiting in the timer heap. Entries from an older generation
+        # are left behind by set_interval and are ignored when they reach the top
+        self.queued = False
+        self.generation = 0
+
+
+class SourceStats:
+    """Timing statistics for a periodic task or file descriptor reader"""
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.total_duration = 0
+        self.last_duration = 0
+        self.max_duration = 0
+        self.max_lateness = 0
+
+    def record(self, duration, lateness=0):
+        self.runs += 1
+        self.total_duration += duration
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.max_lateness = max(self.max_lateness, lateness)
+        if self.interval is not None and duration > self.interval:
+            self.overruns += 1
+
+    def export(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'errors': self.errors,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'last_duration': round(self.last_duration, 6),
+            'mean_duration': round(self.total_duration / self.runs, 6) if self.runs else 0,
+            'max_duration': round(self.max_duration, 6),
+            'max_lateness': round(self.max_lateness, 6)
+        }
+
+
+class AcquisitionScheduler:
+    """
+    Runs periodic sensor polls on drift-free deadlines and dispatches
+    file descriptor readiness callbacks from a single thread.
+
+    Tasks that are added with blocking=True are called from a pool of blocking_threads
+    threads instead, so that slow reads (e.g. 1-wire conversions) never delay the other sources.
+    Different blocking tasks may run concurrently, but a periodic task never overlaps itself.
+    They hand their results back to the scheduler thread using call_soon.
+
+    Tasks may be added or cancelled from any thread.
+    """
+    def __init__(self, blocking_threads=BLOCKING_THREADS):
+        self._lock = threading.Lock()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._stats = {}
+        self._selector = selectors.DefaultSelector()
+        self._thread = None
+        self._blocking = queue.SimpleQueue()
+        self._blocking_threads = blocking_threads
+
+        # Writing to the pipe wakes the loop when a timer is added from another thread
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+        for _ in range(self._blocking_threads):
+            threading.Thread(target=self.__run_blocking, daemon=True).start()
+
+    def __wakeup(self):
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            try:
+                os.write(self._wakeup_write, b'\0')
+            except BlockingIOError:
+                pass
+
+    def __push(self, task):
+        with self._lock:
+            task.queued = True
+            heapq.heappush(self._timers, (task.deadline, next(self._sequence), task, task.generation))
+        self.__wakeup()
+        return task
+
+    def add_periodic(self, name, interval, callback, delay=0, blocking=False):
+        """
+        Calls callback every interval seconds, starting after delay seconds.
+        Blocking callbacks are skipped (and counted) if the previous call has not returned.
+        name must be unique, as it identifies the task in stats().
+        """
+        stats = SourceStats(interval)
+        with self._lock:
+            if name in self._stats:
+                raise ValueError('acquisition task {} already exists'.format(name))
+            self._stats[name] = stats
+        return self.__push(ScheduledTask(name, callback, time.monotonic() + delay, interval, blocking, stats))
+
+    def call_later(self, delay, callback, name=None, blocking=False):
+        """Calls callback once after delay seconds"""
+        return self.__push(ScheduledTask(name, callback, time.monotonic() + delay, blocking=blocking))
+
+    def call_soon(self, callback, name=None, blocking=False):
+        """Calls callback from the scheduler thread (or a blocking thread) as soon as possible"""
+        return self.call_later(0, callback, name, blocking)
+
+    def cancel(self, task):
+        """Stops a task returned by add_periodic or call_later from running again"""
+        task.cancelled = True
+        if task.stats is not None:
+            with self._lock:
+                if self._stats.get(task.name) is task.stats:
+                    del self._stats[task.name]
+
+    def set_interval(self, task, interval):
+        """
+        Changes the interval of a task returned by add_periodic. The time until the task next runs
+        is measured from the start of its last run (or is the new interval if called from its own
+        non-blocking callback). Must be called from the scheduler thread.
+        """
+        with self._lock:
+            if task.queued and not task.cancelled:
+                task.deadline += interval - task.interval
+                task.generation += 1
+                heapq.heappush(self._timers, (task.deadline, next(self._sequence), task, task.generation))
+            task.interval = interval
+            task.stats.interval = interval
+
+    def add_reader(self, name, fd, callback):
+        """
+        Calls callback whenever fd becomes readable. Readers that are added again
+        with the same name (e.g. after reconnecting) share their statistics.
+        Must be called from the scheduler thread
+        """
+        with self._lock:
+            stats = self._stats.setdefault(name, SourceStats())
+        self._selector.register(fd, selectors.EVENT_READ, (name, callback, stats))
+
+    def remove_reader(self, fd):
+        """Stops watching fd. Must be called from the scheduler thread"""
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def __invoke(self, name, callback, stats, lateness=0):
+        start = time.monotonic()
+        error = False
+        try:
+            callback()
+        except Exception:
+            error = True
+            print('Exception in acquisition task {}'.format(name))
+            traceback.print_exc(file=sys.stdout)
+
+        if stats is not None:
+            with self._lock:
+                stats.record(time.monotonic() - start, lateness)
+                if error:
+                    stats.errors += 1
+
+    def __run_blocking(self):
+        while True:
+            task, lateness = self._blocking.get()
+            if not task.cancelled:
+                self.__invoke(task.name, task.callback, task.stats, lateness)
+            task.running = False
+
+    def __dispatch(self, task, lateness):
+        """Calls a task that has become due, or queues it for the blocking threads"""
+        if not task.blocking:
+            self.__invoke(task.name, task.callback, task.stats, lateness)
+        elif task.running:
+            # The previous call is still blocked, so this one is dropped
+            if task.stats is not None:
+                with self._lock:
+                    task.stats.skipped += 1
+        else:
+            task.running = True
+            self._blocking.put((task, lateness))
+
+    def __run(self):
+        while True:
+            with self._lock:
+                timeout = max(0, self._timers[0][0] - time.monotonic()) if self._timers else None
+
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_read, 64):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.__invoke(*key.data)
+
+            while True:
+                now = time.monotonic()
+                with self._lock:
+                    if not self._timers or self._timers[0][0] > now:
+                        break
+                    _, _, task, generation = heapq.heappop(self._timers)
+                    if generation != task.generation:
+                        continue
+                    task.queued = False
+
+                if task.cancelled:
+                    continue
+
+                self.__dispatch(task, now - task.deadline)
+
+                if task.interval is not None and not task.cancelled:
+                    # Deadlines advance on a fixed grid so that timing does not drift.
+                    # Slots that have already passed are skipped rather than run back-to-back
+                    task.deadline += task.interval
+                    now = time.monotonic()
+                    if task.deadline <= now:
+                        missed = math.ceil((now - task.deadline) / task.interval)
+                        task.deadline += missed * task.interval
+                        with self._lock:
+                            task.stats.skipped += missed
+                    self.__push(task)
+
+    def stats(self):
+        """Returns a dictionary of timing statistics for each named source"""
+        with self._lock:
+            return {name: stats.export() for name, stats in self._stats.items()}
@@ -0,0 +1,116 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checkpoints the filter state and latest values so that they survive a daemon restart"""
+
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+STATE_VERSION = 1
+
+
+class StateCheckpoint:
+    """
+    Writes state dictionaries to a json file from a background thread.
+    The file is replaced atomically, so a crash while writing leaves the previous checkpoint intact.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._pending = None
+        self._event = threading.Event()
+        self._error = False
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def submit(self, state):
+        """Queues state to be written, replacing any that has not been written yet. Never blocks on disk I/O"""
+        with self._lock:
+            self._pending = state
+        self._event.set()
+
+    def write(self, state):
+        """Writes state immediately"""
+        with self._lock:
+            self._pending = None
+            self.__write(state)
+
+    def __write(self, state):
+        """Must be called with self._lock held"""
+        data = {
+            'version': STATE_VERSION,
+            'time': time.time(),
+            'state': state
+        }
+
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f_file:
+                json.dump(data, f_file)
+                f_file.flush()
+                os.fsync(f_file.fileno())
+            os.replace(temp_path, self._path)
+
+            if self._error:
+                print('info: Resumed writing state checkpoint ' + self._path)
+                self._error = False
+        except Exception:
+            # Only report the first of a run of failures
+            if not self._error:
+                print('error: Failed to write state checkpoint ' + self._path)
+                traceback.print_exc(file=sys.stdout)
+                self._error = True
+
+    def __run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            with self._lock:
+                state = self._pending
+                self._pending = None
+                if state is not None:
+                    self.__write(state)
+
+
+def load_state(path, max_age):
+    """
+    Returns the state saved by a StateCheckpoint, or None if the file
+    is missing, unreadable, or older than max_age seconds
+    """
+    try:
+        with open(path, 'r') as f_file:
+            data = json.load(f_file)
+
+        if data.get('version') != STATE_VERSION:
+            return None
+
+        age = time.time() - data['time']
+        if age < 0 or age > max_age:
+            return None
+
+        return data['state']
+    except FileNotFoundError:
+        return None
+    except Exception:
+        print('error: Failed to read state checkpoint ' + path)
+        traceback.print_exc(file=sys.stdout)
+        return None
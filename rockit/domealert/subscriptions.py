@@ -0,0 +1,152 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pushes new measurement snapshots to Pyro callback objects"""
+
+import sys
+import threading
+import time
+import traceback
+import uuid
+import Pyro4
+from .measurements import filter_snapshot
+
+# Subscribers are dropped after this many consecutive failed callbacks
+MAX_CALLBACK_FAILURES = 5
+
+# Timeout for each callback to a subscriber
+CALLBACK_TIMEOUT = 5
+
+
+class Subscription:
+    """
+    Delivers snapshots to a single subscriber from its own thread.
+    Only the most recent undelivered snapshot is kept, so a slow subscriber
+    skips intermediate updates instead of delaying acquisition or other subscribers.
+    """
+    def __init__(self, subscription_id, callback_uri, fields, min_interval):
+        self.id = subscription_id
+        self.fields = fields
+        self.last_sequence = 0
+        self.active = True
+        self._callback_uri = callback_uri
+        self._min_interval = min_interval
+        self._condition = threading.Condition()
+        self._pending = None
+        self._failures = 0
+
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def offer(self, sequence, snapshot):
+        """Replaces any undelivered snapshot with a newer one. Never blocks"""
+        with self._condition:
+            self.last_sequence = sequence
+            self._pending = (sequence, filter_snapshot(snapshot, self.fields))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self.active = False
+            self._condition.notify()
+
+    def __run(self):
+        # Pyro4's proxy methods are prefixed with _pyro so that they don't clash with remote methods
+        # pylint: disable=protected-access
+        proxy = Pyro4.Proxy(self._callback_uri)
+        proxy._pyroTimeout = CALLBACK_TIMEOUT
+        try:
+            while True:
+                with self._condition:
+                    while self.active and self._pending is None:
+                        self._condition.wait()
+
+                    if not self.active:
+                        return
+
+                    sequence, snapshot = self._pending
+                    self._pending = None
+
+                start = time.monotonic()
+                try:
+                    proxy.measurement_updated(sequence, snapshot)
+                    self._failures = 0
+                except Exception:
+                    self._failures += 1
+                    if self._failures == 1:
+                        print('Failed to notify subscriber ' + self._callback_uri)
+                        traceback.print_exc(file=sys.stdout)
+
+                    if self._failures >= MAX_CALLBACK_FAILURES:
+                        print('Dropping subscriber ' + self._callback_uri)
+                        self.active = False
+                        return
+
+                    # Force the proxy to reconnect on the next attempt
+                    proxy._pyroRelease()
+
+                # Rate limit deliveries; anything that arrives in the meantime is coalesced
+                delay = self._min_interval - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            proxy._pyroRelease()
+
+
+class SubscriptionManager:
+    """Watches the measurement store and hands new snapshots to each subscription"""
+    def __init__(self, store, poll_timeout=5):
+        self._store = store
+        self._poll_timeout = poll_timeout
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def subscribe(self, callback_uri, fields=None, min_interval=0):
+        subscription_id = str(uuid.uuid4())
+        with self._lock:
+            subscription = Subscription(subscription_id, callback_uri, fields, min_interval)
+            self._subscriptions[subscription_id] = subscription
+
+        # Deliver the current state immediately
+        subscription.offer(*self._store.wait(0, 0, None))
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        with self._lock:
+            subscription = self._subscriptions.pop(subscription_id, None)
+
+        if subscription is None:
+            return False
+
+        subscription.close()
+        return True
+
+    def __run(self):
+        sequence = 0
+        while True:
+            try:
+                sequence, snapshot = self._store.wait(sequence, self._poll_timeout)
+                with self._lock:
+                    for subscription_id, subscription in list(self._subscriptions.items()):
+                        if not subscription.active:
+                            del self._subscriptions[subscription_id]
+                        elif self._store.last_sequence(subscription.fields) > subscription.last_sequence:
+                            subscription.offer(sequence, snapshot)
+            except Exception:
+                print('Exception while dispatching measurement subscriptions')
+                traceback.print_exc(file=sys.stdout)
+                time.sleep(1)
@@ -19,18 +19,36 @@ import sys
 import threading
 import time
 import traceback
-import RPi.GPIO as GPIO
+
+try:
+    import RPi.GPIO as GPIO
+except (ImportError, RuntimeError):
+    # RPi.GPIO can only be imported on a Raspberry Pi.
+    # Other systems must pass an equivalent backend to SwitchSensorsWatcher.
+    GPIO = None
 
 # Pin assigment for channels 0-7
-# TODO Change to .BOARD
-CHANNEL_PIN_TYPE = GPIO.BCM
 CHANNEL_PINS = [21, 20, 26, 16, 19, 13, 12, 6]
 RELAY_PIN = 5
 
+# Inputs are also polled at this interval (in seconds) in edge detection mode,
+# so that a missed edge callback can't leave a stale level published
+EDGE_RESYNC_INTERVAL = 10
+
 
-class SwitchSensorsWatcher:
-    def __init__(self, config, poll_rate=1, age_timeout=2.5):
+class SwitchSensorsWatcher:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, config, store, scheduler, metrics, poll_rate=1, age_timeout=2.5, edge_detect=False, debounce=20,
+                 gpio=None):
+        if gpio is None:
+            if GPIO is None:
+                raise ImportError('RPi.GPIO is not available')
+            gpio = GPIO
+
+        self._gpio = gpio
         self._config = config
+        self._store = store
+        self._scheduler = scheduler
+        self._metrics = metrics
         self._updated = datetime.datetime.min
         self._channels = [False for _ in CHANNEL_PINS]
         self._lock = threading.Lock()
@@ -38,48 +56,178 @@ class SwitchSensorsWatcher:
         self._age_timeout = age_timeout
         self._available = False
 
-        GPIO.setwarnings(False)
-        GPIO.setmode(CHANNEL_PIN_TYPE)
-        GPIO.setup(CHANNEL_PINS, GPIO.IN)
-        GPIO.setup(RELAY_PIN, GPIO.OUT)
+        # Edge detection state: the inputs are only sampled after they have
+        # been stable for debounce milliseconds following an edge
+        self._edge_detect = edge_detect
+        self._debounce = debounce / 1000.
+        self._transitions = [0 for _ in CHANNEL_PINS]
+        self._changed = [None for _ in CHANNEL_PINS]
+        self._pending = [None for _ in CHANNEL_PINS]
+
+        for s in config:
+            store.register(s['id'], False)
+
+        gpio.setwarnings(False)
+
+        # TODO Change to .BOARD
+        gpio.setmode(gpio.BCM)
+        gpio.setup(CHANNEL_PINS, gpio.IN)
+        gpio.setup(RELAY_PIN, gpio.OUT)
+
+        if edge_detect:
+            self.__start_edge_detection()
+        self._task = self.__add_poll_task()
+
+    def reconfigure(self, config, edge_detect=False, debounce=20):
+        """
+        Applies a new set of switch definitions, switching between polling and
+        edge detection if needed. Must be called from the scheduler thread.
+        """
+        ids = {s['id'] for s in config}
+        removed = [s['id'] for s in self._config if s['id'] not in ids]
+        if removed:
+            self._store.unregister(removed)
+
+        with self._lock:
+            previous_ids = {s['id'] for s in self._config}
+            for s in config:
+                if s['id'] not in previous_ids:
+                    self._store.register(s['id'], False)
+
+            self._config = config
+            self._debounce = debounce / 1000.
+            if self._available:
+                self.__publish()
+
+        if edge_detect == self._edge_detect:
+            return
+
+        if self._edge_detect:
+            for pin in CHANNEL_PINS:
+                self._gpio.remove_event_detect(pin)
+        self._scheduler.cancel(self._task)
 
-        loop = threading.Thread(target=self.__poll_inputs)
-        loop.daemon = True
-        loop.start()
+        self._edge_detect = edge_detect
+        if edge_detect:
+            self.__start_edge_detection()
+        self._task = self.__add_poll_task()
+
+    def __add_poll_task(self):
+        """Polls the inputs, or resynchronises them at a slower rate in edge detection mode"""
+        if self._edge_detect:
+            return self._scheduler.add_periodic('switches', EDGE_RESYNC_INTERVAL, self.__poll_inputs,
+                                                delay=EDGE_RESYNC_INTERVAL)
+        return self._scheduler.add_periodic('switches', self._poll_rate, self.__poll_inputs)
 
     def get_relay(self):
-        return GPIO.input(RELAY_PIN) == GPIO.HIGH
+        return self._gpio.input(RELAY_PIN) == self._gpio.HIGH
 
     def set_relay(self, enabled):
-        GPIO.output(RELAY_PIN, enabled)
+        self._gpio.output(RELAY_PIN, enabled)
 
     def __poll_inputs(self):
-        while True:
-            updated = False
-            try:
-                with self._lock:
-                    for i, pin in enumerate(CHANNEL_PINS):
-                        self._channels[i] = GPIO.input(pin) == GPIO.LOW
-
-                    self._updated = datetime.datetime.now(datetime.timezone.utc)
-                    updated = True
-            except Exception:
-                if self._available:
-                    print('Exception while polling switches')
-                    traceback.print_exc(file=sys.stdout)
-            finally:
-                if updated != self._available:
-                    if updated:
-                        print('Switches connected')
+        updated = False
+        start = time.monotonic()
+        try:
+            with self._lock:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                for i, pin in enumerate(CHANNEL_PINS):
+                    # Channels that are debouncing an edge are sampled once they settle
+                    if self._pending[i] is not None:
+                        continue
+
+                    state = self._gpio.input(pin) == self._gpio.LOW
+                    if self._updated == datetime.datetime.min:
+                        # Don't count the initial state as a transition
+                        self._channels[i] = state
                     else:
-                        print('Switches disconnected')
+                        if self._edge_detect and state != self._channels[i]:
+                            self._metrics.increment('domealert_gpio_missed_edges_total', channel=i)
+                        self.__update_channel(i, state, now)
+
+                self._updated = now
+                self.__publish()
+                updated = True
+            self._metrics.observe('domealert_gpio_poll_seconds', time.monotonic() - start)
+        except Exception:
+            self._metrics.increment('domealert_gpio_errors_total')
+            if self._available:
+                print('Exception while polling switches')
+                traceback.print_exc(file=sys.stdout)
+        finally:
+            if updated != self._available:
+                if updated:
+                    print('Switches connected')
+                else:
+                    print('Switches disconnected')
+
+            self._available = updated
+
+    def __start_edge_detection(self):
+        try:
+            with self._lock:
+                for i, pin in enumerate(CHANNEL_PINS):
+                    self._channels[i] = self._gpio.input(pin) == self._gpio.LOW
+                    self._gpio.add_event_detect(pin, self._gpio.BOTH, callback=self.__input_edge)
+
+                self._updated = datetime.datetime.now(datetime.timezone.utc)
+                self._available = True
+                self.__publish()
+            print('Switches connected')
+        except Exception:
+            print('Exception while configuring switch edge detection')
+            traceback.print_exc(file=sys.stdout)
+
+    def __input_edge(self, pin):
+        """Called from the GPIO event thread when an input changes level"""
+        i = CHANNEL_PINS.index(pin)
+        self._metrics.increment('domealert_gpio_edges_total', channel=i)
+        with self._lock:
+            # Contact bounce generates a burst of edges: timestamp the first one
+            # and sample the settled level once the debounce period has passed
+            if self._pending[i] is not None:
+                return
+
+            self._pending[i] = datetime.datetime.now(datetime.timezone.utc)
+
+        self._scheduler.call_later(self._debounce, lambda: self.__input_settled(i, pin), 'switch_debounce')
+
+    def __input_settled(self, i, pin):
+        try:
+            with self._lock:
+                # Edges that arrive after the pending flag is cleared schedule a new sample,
+                # so the pin must be read afterwards to avoid missing the final level
+                timestamp = self._pending[i]
+                self._pending[i] = None
+                state = self._gpio.input(pin) == self._gpio.LOW
+                self.__update_channel(i, state, timestamp)
+                self.__publish()
+        except Exception:
+            with self._lock:
+                self._pending[i] = None
+            print('Exception while reading switch channel {}'.format(i))
+            traceback.print_exc(file=sys.stdout)
+
+    def __update_channel(self, i, state, timestamp):
+        """Records a new level for channel i. Must be called with self._lock held"""
+        if state != self._channels[i]:
+            self._channels[i] = state
+            self._transitions[i] += 1
+            self._changed[i] = timestamp
+            self._metrics.increment('domealert_switch_transitions_total', channel=i)
 
-                self._available = updated
-                time.sleep(self._poll_rate)
+    def __publish(self):
+        """Publishes the channel states to the measurement store. Must be called with self._lock held"""
+        # Channel state is updated as edges arrive in edge detection mode, and only goes stale
+        # if the periodic resynchronisation also stops
+        timeout = EDGE_RESYNC_INTERVAL + self._age_timeout if self._edge_detect else self._age_timeout
+        self._store.update({s['id']: self._channels[s['channel']] for s in self._config}, timeout)
 
-    def export_measurements(self, data):
+    def export_transitions(self, data):
         with self._lock:
-            switch_valid = (datetime.datetime.now(datetime.timezone.utc) - self._updated).total_seconds() < self._age_timeout
             for s in self._config:
-                data[s['id']] = self._channels[s['channel']]
-                data[s['id'] + '_valid'] = switch_valid
+                changed = self._changed[s['channel']]
+                data[s['id']] = {
+                    'count': self._transitions[s['channel']],
+                    'changed': changed.strftime('%Y-%m-%dT%H:%M:%S.%fZ') if changed else None
+                }
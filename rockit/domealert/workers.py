@@ -0,0 +1,465 @@
+#
+# This file is part of the Robotic Observatory Control Kit (rockit)
+#
+# rockit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rockit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rockit.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Runs sensor acquisition in supervised child processes that publish through shared memory"""
+
+import multiprocessing
+from multiprocessing import connection, shared_memory
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from .digitalsensors import DigitalSensorsWatcher
+from .measurements import MeasurementStore
+from .metrics import Metrics
+from .rj11sensors import RJ11SensorsWatcher, W1_DEVICES_PATH
+from .scheduler import AcquisitionScheduler
+
+# seqlock sequence, CRC-32 of the rest of the block
+BLOCK_SEQUENCE_STRUCT = struct.Struct('<QL')
+
+# heartbeat (monotonic time)
+BLOCK_HEARTBEAT_STRUCT = struct.Struct('<d')
+
+BLOCK_HEADER_SIZE = BLOCK_SEQUENCE_STRUCT.size + BLOCK_HEARTBEAT_STRUCT.size
+
+# value, raw value, monotonic time of the sample (0 if never sampled), monotonic expiry time
+BLOCK_SLOT_STRUCT = struct.Struct('<dddd')
+
+# Maximum time to retry reading a block that is being written, in seconds
+BLOCK_READ_TIMEOUT = 0.1
+
+# Interval between worker heartbeats in seconds
+HEARTBEAT_INTERVAL = 1
+
+# Workers that miss heartbeats for this long are assumed to have hung, and are restarted
+HEARTBEAT_TIMEOUT = 5 * HEARTBEAT_INTERVAL
+
+# Allowance for a new worker to start its interpreter and import the sensor modules
+WORKER_START_TIMEOUT = 30
+
+# Crashed workers are restarted after a delay that backs off between these limits (in seconds)
+RESTART_MIN_DELAY = 1
+RESTART_MAX_DELAY = 60
+
+# Workers that run for this long reset the restart backoff
+RESTART_RESET_TIME = 60
+
+# Workers are spawned rather than forked, as the daemon's threads may hold locks
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class MeasurementBlock:
+    """
+    A fixed array of measurement slots in shared memory, written by a single process
+    and read by another. Readers copy the whole block and retry if the sequence number
+    was odd (a write was in progress) or the copy doesn't match the checksum.
+
+    Python has no memory barriers, so another core may observe the writer's stores in a
+    different order (e.g. on the ARM CPU of a Raspberry Pi) and the sequence number alone
+    can't guarantee a consistent copy. Each write therefore finishes by storing a CRC-32
+    of the block, which detects copies that mix old and new bytes.
+    """
+    def __init__(self, shm, field_count):
+        self._shm = shm
+        self._field_count = field_count
+        self._size = self.size(field_count)
+
+    @staticmethod
+    def size(field_count):
+        return BLOCK_HEADER_SIZE + field_count * BLOCK_SLOT_STRUCT.size
+
+    def clear(self):
+        """Marks every slot as never sampled. Must not be called while a worker may be writing"""
+        buf = self._shm.buf
+        buf[:self._size] = bytes(self._size)
+        BLOCK_SEQUENCE_STRUCT.pack_into(buf, 0, 0, zlib.crc32(buf[BLOCK_SEQUENCE_STRUCT.size:self._size]))
+
+    def write(self, slots):
+        """Writes a dictionary of slot index to (value, raw, updated, expires)"""
+        buf = self._shm.buf
+        sequence, checksum = BLOCK_SEQUENCE_STRUCT.unpack_from(buf, 0)
+        BLOCK_SEQUENCE_STRUCT.pack_into(buf, 0, sequence + 1, checksum)
+        for index, slot in slots.items():
+            BLOCK_SLOT_STRUCT.pack_into(buf, BLOCK_HEADER_SIZE + index * BLOCK_SLOT_STRUCT.size, *slot)
+        BLOCK_HEARTBEAT_STRUCT.pack_into(buf, BLOCK_SEQUENCE_STRUCT.size, time.monotonic())
+        checksum = zlib.crc32(buf[BLOCK_SEQUENCE_STRUCT.size:self._size])
+        BLOCK_SEQUENCE_STRUCT.pack_into(buf, 0, sequence + 2, checksum)
+
+    def heartbeat(self):
+        self.write({})
+
+    def read(self):
+        """
+        Returns a tuple of (heartbeat, list of (value, raw, updated, expires) for each slot),
+        or None if no consistent copy was made within BLOCK_READ_TIMEOUT because the writer
+        was killed part way through a write
+        """
+        deadline = time.monotonic() + BLOCK_READ_TIMEOUT
+        while True:
+            data = bytes(self._shm.buf[:self._size])
+            sequence, checksum = BLOCK_SEQUENCE_STRUCT.unpack_from(data, 0)
+            if sequence % 2 == 0 and zlib.crc32(data[BLOCK_SEQUENCE_STRUCT.size:]) == checksum:
+                break
+
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0)
+
+        heartbeat, = BLOCK_HEARTBEAT_STRUCT.unpack_from(data, BLOCK_SEQUENCE_STRUCT.size)
+        slots = [BLOCK_SLOT_STRUCT.unpack_from(data, BLOCK_HEADER_SIZE + i * BLOCK_SLOT_STRUCT.size)
+                 for i in range(self._field_count)]
+        return heartbeat, slots
+
+
+class BlockWriter:
+    """
+    Store listener that copies each update into a MeasurementBlock and wakes the supervisor.
+    The worker's metrics and filter state are sent to the supervisor with each heartbeat.
+    """
+    def __init__(self, block, fields, store, notify_fd, status_sender):
+        self._block = block
+        self._fields = {f: i for i, f in enumerate(fields)}
+        self._store = store
+        self._notify_fd = notify_fd
+        self._status_sender = status_sender
+
+    def record(self, values, raw, _):
+        now = time.monotonic()
+        slots = {}
+        for sensor_id, value in values.items():
+            index = self._fields.get(sensor_id)
+            if index is not None:
+                slots[index] = (value, raw.get(sensor_id, value), now, now + self._store.remaining(sensor_id))
+
+        if slots:
+            self._block.write(slots)
+            try:
+                os.write(self._notify_fd, b'\0')
+            except BlockingIOError:
+                # The supervisor hasn't caught up yet, but will read every slot when it does
+                pass
+            except BrokenPipeError:
+                # The daemon has exited, and run_worker will follow
+                pass
+
+    def heartbeat(self, status):
+        """Updates the heartbeat in the block and sends status (a dictionary of metrics and filters)"""
+        self._block.heartbeat()
+        try:
+            self._status_sender.send(status)
+        except BrokenPipeError:
+            pass
+
+
+def attach_shared_memory(name):
+    """Attaches to an existing block that is owned (and unlinked) by the daemon"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)  # pylint: disable=unexpected-keyword-arg
+
+    # Older versions always register the block with the resource tracker. Spawned workers
+    # share the daemon's tracker, so the duplicate registration is harmless
+    return shared_memory.SharedMemory(name)
+
+
+def run_worker(kind, config, fields, shm_name, notify, status_sender, filter_state, w1_devices_path):
+    """
+    Entry point for a worker process that runs the digital or rj11 sensors.
+    filter_state is a dictionary of sensor id to filter state to restore.
+    """
+    parent = os.getppid()
+    shm = attach_shared_memory(shm_name)
+    notify_fd = notify.fileno()
+    os.set_blocking(notify_fd, False)
+
+    store = MeasurementStore()
+    scheduler = AcquisitionScheduler()
+    metrics = Metrics()
+    writer = BlockWriter(MeasurementBlock(shm, len(fields)), fields, store, notify_fd, status_sender)
+    store.add_listener(writer.record)
+
+    if kind == 'digital':
+        watcher = DigitalSensorsWatcher(config, store, scheduler, metrics)
+    else:
+        watcher = RJ11SensorsWatcher(config.rj11_sensors, store, scheduler, metrics, config.sensor_poll_rate,
+                                     config.sensor_median_samples, config.sensor_timeout,
+                                     bulk_read=config.rj11_bulk_read, devices_path=w1_devices_path)
+
+    # Restore the filters before the first samples arrive
+    watcher.set_filter_state(filter_state)
+
+    def heartbeat():
+        writer.heartbeat({'metrics': metrics.dump(), 'filters': watcher.get_filter_state()})
+
+    scheduler.add_periodic('heartbeat', HEARTBEAT_INTERVAL, heartbeat)
+    scheduler.start()
+
+    # Exit if the daemon goes away
+    while os.getppid() == parent:
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def worker_fields(kind, config):
+    """Returns the sensor ids measured by a worker"""
+    sensors = config.digital_sensors if kind == 'digital' else config.rj11_sensors
+    return [s['id'] for s in sensors]
+
+
+def worker_settings(kind, config):
+    """Returns the settings that require a worker to be restarted when they change"""
+    if kind == 'digital':
+        return (config.digital_boards, config.digital_sensors, config.sensor_median_samples, config.sensor_timeout)
+    return (config.rj11_sensors, config.sensor_poll_rate, config.sensor_median_samples, config.sensor_timeout,
+            config.rj11_bulk_read)
+
+
+def worker_filters(kind, config):
+    """Returns a dictionary of sensor id to the settings that its filter depends on"""
+    if kind == 'digital':
+        channels = {b['id']: b['channels'] for b in config.digital_boards}
+        filters = {}
+        for s in config.digital_sensors:
+            board_id = s.get('board', config.digital_boards[0]['id'])
+            filters[s['id']] = (board_id, channels[board_id], s['channel'], s['type'], s.get('filters'),
+                                None if 'filters' in s else config.sensor_median_samples)
+        return filters
+    return {s['id']: (s, None if 'filters' in s else config.sensor_median_samples) for s in config.rj11_sensors}
+
+
+class AcquisitionWorker:  # pylint: disable=too-many-instance-attributes
+    """
+    Runs the digital or rj11 sensors (kind) in a child process, mirrors their values
+    from shared memory into store, and restarts the process if it exits or stops sending heartbeats.
+    A read that blocks in the child never delays the daemon.
+
+    The filter state reported by the worker is passed on to its replacement, so that
+    sensors keep their filters across restarts and reconfiguration like they do in the daemon.
+    """
+    def __init__(self, kind, config, store, metrics, w1_devices_path=W1_DEVICES_PATH, filter_state=None):
+        self._kind = kind
+        self._store = store
+        self._metrics = metrics
+        self._w1_devices_path = w1_devices_path
+        self._lock = threading.Lock()
+        self._config = None
+        self._fields = []
+        self._shm = None
+        self._block = None
+        self._process = None
+        self._receiver = None
+        self._status_receiver = None
+        self._filter_state = filter_state or {}
+        self._started = 0
+        self._heartbeat_deadline = 0
+        self._restarts = 0
+        self._restart_delay = RESTART_MIN_DELAY
+        self._closed = False
+
+        # Monotonic time of the last sample mirrored for each field
+        self._updated = []
+
+        self.reconfigure(config)
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def reconfigure(self, config):
+        """Restarts the worker with a new configuration if any of its settings have changed"""
+        with self._lock:
+            if self._config is not None and worker_settings(self._kind, config) == \
+                    worker_settings(self._kind, self._config):
+                self._config = config
+                return
+
+            # Sensors whose filter settings have changed start with an empty filter
+            if self._config is not None:
+                previous = worker_filters(self._kind, self._config)
+                filters = worker_filters(self._kind, config)
+                self._filter_state = {i: s for i, s in self._filter_state.items()
+                                      if i in filters and filters[i] == previous.get(i)}
+
+            fields = worker_fields(self._kind, config)
+            removed = [f for f in self._fields if f not in fields]
+            if removed:
+                self._store.unregister(removed)
+
+            # Fields that are still measured keep their values until they time out
+            for field in fields:
+                if field not in self._fields:
+                    self._store.register(field)
+
+            self.__stop()
+            self._config = config
+            self._fields = fields
+            self._shm = shared_memory.SharedMemory(create=True, size=MeasurementBlock.size(len(fields)))
+            self._block = MeasurementBlock(self._shm, len(fields))
+            self.__start()
+
+    def __start(self):
+        """Must be called with self._lock held"""
+        # A previous worker may have been killed part way through a write
+        self._block.clear()
+        self._updated = [0 for _ in self._fields]
+
+        receiver, sender = MP_CONTEXT.Pipe(duplex=False)
+        os.set_blocking(receiver.fileno(), False)
+        status_receiver, status_sender = MP_CONTEXT.Pipe(duplex=False)
+        self._process = MP_CONTEXT.Process(
+            target=run_worker, daemon=True, name='domealert-' + self._kind,
+            args=(self._kind, self._config, self._fields, self._shm.name, sender, status_sender,
+                  self._filter_state, self._w1_devices_path))
+        self._process.start()
+        sender.close()
+        status_sender.close()
+
+        if self._receiver is not None:
+            self._receiver.close()
+            self._status_receiver.close()
+        self._receiver = receiver
+        self._status_receiver = status_receiver
+        self._started = time.monotonic()
+        self._heartbeat_deadline = self._started + WORKER_START_TIMEOUT
+
+    def __stop(self):
+        """Must be called with self._lock held"""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(5)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+            self._process = None
+            self._metrics.retire(self._kind)
+
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __mirror(self):
+        """Copies new samples from the block into the store. Must be called with self._lock held"""
+        try:
+            while os.read(self._receiver.fileno(), 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        data = self._block.read()
+        if data is None:
+            return []
+
+        _, slots = data
+        now = time.monotonic()
+
+        # Values are grouped by their remaining validity
+        updates = {}
+        for i, (value, raw, updated, expires) in enumerate(slots):
+            if updated in (0, self._updated[i]):
+                continue
+
+            self._updated[i] = updated
+            values, raws = updates.setdefault(expires, ({}, {}))
+            values[self._fields[i]] = value
+            raws[self._fields[i]] = raw
+
+        return [(None if e == float('inf') else e - now, v, r) for e, (v, r) in updates.items()]
+
+    def __receive_status(self):
+        """Merges the metrics and filter state sent with each heartbeat. Must be called with self._lock held"""
+        try:
+            while self._status_receiver.poll():
+                status = self._status_receiver.recv()
+                self._metrics.merge(self._kind, status['metrics'])
+                self._filter_state = status['filters']
+                self._heartbeat_deadline = time.monotonic() + HEARTBEAT_TIMEOUT
+        except EOFError:
+            # The worker has exited, and its sentinel will trigger a restart
+            pass
+
+    def __run(self):
+        while not self._closed:
+            with self._lock:
+                process = self._process
+                receiver = self._receiver
+                status_receiver = self._status_receiver
+
+            ready = connection.wait([receiver, status_receiver, process.sentinel], HEARTBEAT_INTERVAL)
+            updates = []
+            restart = False
+            with self._lock:
+                # The worker may have been replaced by reconfigure while waiting
+                if process is not self._process or self._closed:
+                    continue
+
+                if receiver in ready:
+                    updates = self.__mirror()
+
+                if status_receiver in ready:
+                    self.__receive_status()
+
+                if process.sentinel in ready:
+                    restart = True
+                elif time.monotonic() > self._heartbeat_deadline:
+                    # The worker is hung, e.g. blocked in a driver. Its sentinel will trigger a restart
+                    print('error: {} acquisition worker stopped responding'.format(self._kind))
+                    self._heartbeat_deadline = float('inf')
+                    process.kill()
+
+            # Listeners may call back into the daemon, so are notified without holding the lock
+            for timeout, values, raw in updates:
+                self._store.update(values, timeout, raw)
+
+            if restart:
+                self.__restart(process)
+
+    def __restart(self, process):
+        process.join()
+        print('error: {} acquisition worker exited with code {}'.format(self._kind, process.exitcode))
+        self._metrics.retire(self._kind)
+        self._metrics.increment('domealert_worker_restarts_total', worker=self._kind)
+
+        if time.monotonic() - self._started > RESTART_RESET_TIME:
+            self._restart_delay = RESTART_MIN_DELAY
+
+        time.sleep(self._restart_delay)
+        self._restart_delay = min(2 * self._restart_delay, RESTART_MAX_DELAY)
+
+        with self._lock:
+            if process is self._process and not self._closed:
+                self._restarts += 1
+                self.__start()
+                print('info: Restarted {} acquisition worker'.format(self._kind))
+
+    def filter_state(self):
+        """Returns the filter state last reported by the worker, as a dictionary of sensor id to state"""
+        with self._lock:
+            return self._filter_state
+
+    def stats(self):
+        """Returns the process id, restart count and time since the last heartbeat"""
+        with self._lock:
+            data = self._block.read()
+            heartbeat = data[0] if data is not None else 0
+            return {
+                'pid': self._process.pid if self._process is not None else None,
+                'restarts': self._restarts,
+                'heartbeat_age': round(time.monotonic() - heartbeat, 3) if heartbeat else None
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self.__stop()